@@ -0,0 +1,117 @@
+"""Golden check + addresses/sec for the compiled AddressNormalizer vs the old per-call V16 cleaner.
+
+    python benchmarks/bench_clean_address.py [workbook.xlsx ...]
+
+The corpus is every Full_Address value found in the given workbooks (default: the FINAL_DOCTORS_BATCH_*
+outputs and the registry workbooks next to main.py). If none of them carry a Full_Address column the
+synthetic corpus below is used instead. Any output that is not byte-identical fails the run.
+"""
+import glob
+import os
+import random
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pandas as pd  # noqa: E402
+
+import main  # noqa: E402
+
+
+def reference_clean(raw_addr):
+    """The pre-compilation clean_bg_address algorithm, kept verbatim (minus the inline lists) as the oracle."""
+    if not isinstance(raw_addr, str) or not raw_addr:
+        return ""
+    if len(raw_addr) < 25 and any(x in raw_addr.upper() for x in main.BRAINROT_INDICATORS):
+        return "INVALID_ADDRESS_METADATA"
+    clean = raw_addr.replace('№', ' ').replace(' N ', ' ').replace(' No ', ' ').replace('номер', ' ')
+    clean = clean.replace('"', '').replace('„', '').replace('“', '').replace("'", "").replace("`", "")
+    clean = re.sub(r'\s+', ' ', clean)
+    clean = re.sub(r'Обл\.\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
+    clean = re.sub(r'област\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
+    clean = re.sub(r'Общ\.\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
+    clean = re.sub(r'община\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
+    clean = re.sub(r'^\s*\d+[\.,]\s*', '', clean)
+    stop_words = list(main.STOP_WORDS)
+    pattern_str = r'([,\s\(\.\/-]+)(' + '|'.join(stop_words) + r').*$'
+    clean = re.sub(pattern_str, '', clean, flags=re.IGNORECASE)
+    clean = re.sub(r'\(.*?\)', '', clean)
+    clean = re.sub(r'/.*?/', '', clean)
+    clean = re.sub(r'\bномер\b', '', clean, flags=re.IGNORECASE)
+    clean = re.sub(r'\bс\.\s*$', '', clean)
+    clean = re.sub(r'\bул\.\s*$', '', clean)
+    clean = re.sub(r'\s+', ' ', clean)
+    clean = re.sub(r'\s,', ',', clean)
+    clean = re.sub(r',+', ',', clean)
+    clean = clean.strip(' ,.-/\\')
+    if len(clean) < 3:
+        if "гр." in raw_addr or "с." in raw_addr:
+            city_match = re.search(r'(гр\.|с\.)\s*([А-Яа-я\s\-]+)', raw_addr)
+            if city_match:
+                return city_match.group(0)
+        return "INVALID_ADDRESS_TOO_SHORT"
+    return clean
+
+
+FRAGMENTS = [
+    "гр. София", "с. Горна баня", "гр. Пловдив", "ул. Иван Вазов", "бул. България", "ж.к. Тракия", "кв. Изток",
+    "№ 12", "No 5", " N 7", "номер 3", "\"Здраве\"", "„Св. Анна“", "обл. Пловдив", "общ. Бургас", "Община Русе",
+    "1.", "ет. 2", "етаж 3", "ап.5", "каб. 4", "ДКЦ 1", "МБАЛ", "Поликлиника", "вх. А", "бл. 5", "(до аптеката)",
+    "/стар адрес/", "Здравна служба", "ЗАЛИЧЕН", "СЗС", "с.", "ул.", "Mall Plovdiv", "ТЦ Мега", "Е-1", "К-3",
+]
+
+
+def synthetic_corpus(size, seed=16):
+    rnd = random.Random(seed)
+    seps = ["", " ", ", ", ",", " - ", "  "]
+    return ["".join(rnd.choice(FRAGMENTS) + rnd.choice(seps) for _ in range(rnd.randint(1, 7))) for _ in range(size)]
+
+
+def load_corpus(paths):
+    values = []
+    for path in paths:
+        try:
+            sheets = pd.read_excel(path, sheet_name=None, dtype=str)
+        except Exception as e:
+            print(f"skip {path}: {e}")
+            continue
+        for df in sheets.values():
+            if 'Full_Address' in df.columns:
+                values.extend(df['Full_Address'].tolist())
+    return values
+
+
+def rate(fn, corpus):
+    t0 = time.perf_counter()
+    out = [fn(a) for a in corpus]
+    return out, len(corpus) / (time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or sorted(glob.glob(os.path.join(ROOT, "FINAL_DOCTORS_BATCH_*.xlsx"))) + \
+        sorted(glob.glob(os.path.join(ROOT, "BG_Medical_Registry_*.xlsx")))
+    corpus = load_corpus(paths)
+    source = "Full_Address columns"
+    if not corpus:
+        corpus = synthetic_corpus(20000)
+        source = "synthetic corpus"
+    print(f"corpus: {len(corpus)} addresses ({source})")
+
+    old_out, old_rate = rate(reference_clean, corpus)
+    new_out, new_rate = rate(main.ADDRESS_NORMALIZER.clean, corpus)
+    t0 = time.perf_counter()
+    batch_out = main.ADDRESS_NORMALIZER.clean_many(pd.Series(corpus, dtype=object)).tolist()
+    batch_rate = len(corpus) / (time.perf_counter() - t0)
+
+    mismatches = [(a, o, n) for a, o, n in zip(corpus, old_out, new_out) if o != n]
+    mismatches += [(a, o, b) for a, o, b in zip(corpus, old_out, batch_out) if o != b]
+    for raw, old, new in mismatches[:10]:
+        print(f"MISMATCH {raw!r}: {old!r} != {new!r}")
+
+    print(f"per-call V16 : {old_rate:10.0f} addresses/sec")
+    print(f"compiled     : {new_rate:10.0f} addresses/sec (x{new_rate / old_rate:.1f})")
+    print(f"clean_many   : {batch_rate:10.0f} addresses/sec (x{batch_rate / old_rate:.1f}, dedups repeats)")
+    sys.exit(1 if mismatches else 0)
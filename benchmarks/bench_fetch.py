@@ -0,0 +1,72 @@
+"""Sequential (old sleep-based loop) vs concurrent fetch engine against the throttling stub.
+
+    python benchmarks/bench_fetch.py --ids 60 --rate 5 --concurrency 4
+
+The concurrent run has to get every ID, end at or below the stub's --rate and keep its 429s under
+--max-429 (a share of --ids); anything else fails the run.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from stub_api import start_in_thread  # noqa: E402
+
+
+def run_sequential(ids, sleep_range):
+    ok = 0
+    for id_number in ids:
+        if main.fetch_details(id_number):
+            ok += 1
+        time.sleep(random.uniform(*sleep_range))
+    return ok
+
+
+def run_concurrent(ids, concurrency):
+    session = main.make_session(concurrency)
+    limiter = main.AdaptiveRateLimiter()
+    ok = sum(1 for _, data, _ in main.fetch_many(ids, session, limiter, concurrency) if data)
+    session.close()
+    return ok, limiter
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ids", type=int, default=60)
+    parser.add_argument("--rate", type=float, default=5.0, help="stub WAF threshold, req/s")
+    parser.add_argument("--latency", type=float, default=0.15)
+    parser.add_argument("--concurrency", type=int, default=main.CONCURRENCY)
+    parser.add_argument("--sleep", type=float, nargs=2, default=(0.5, 1.2), help="old loop sleep range")
+    parser.add_argument("--max-429", type=float, default=0.1, help="allowed 429s per ID in the concurrent run")
+    args = parser.parse_args()
+
+    server, main.API_URL = start_in_thread(rate=args.rate, latency=args.latency)
+    ids = [f"{i:012d}" for i in range(1, args.ids + 1)]
+
+    t0 = time.perf_counter()
+    ok_seq = run_sequential(ids, args.sleep)
+    seq = time.perf_counter() - t0
+    print(f"sequential : {ok_seq}/{len(ids)} ok in {seq:.1f}s -> {len(ids) / seq:.2f} ids/s")
+
+    rejected_before = server.throttle.rejected
+    t0 = time.perf_counter()
+    ok_con, limiter = run_concurrent(ids, args.concurrency)
+    con = time.perf_counter() - t0
+    rejected = server.throttle.rejected - rejected_before
+    print(f"concurrent : {ok_con}/{len(ids)} ok in {con:.1f}s -> {len(ids) / con:.2f} ids/s "
+          f"(x{seq / con:.1f}, 429s={rejected}, final rate={limiter.rate:.2f}/s)")
+    server.shutdown()
+
+    problems = []
+    if ok_con != len(ids):
+        problems.append(f"only {ok_con} of {len(ids)} IDs came back ok")
+    if rejected > args.max_429 * len(ids):
+        problems.append(f"{rejected} 429s, allowed {args.max_429 * len(ids):.0f}")
+    if limiter.rate > args.rate:
+        problems.append(f"final rate {limiter.rate:.2f}/s is above the stub's {args.rate:.2f}/s")
+    print("OK" if not problems else "PROBLEMS:\n  " + "\n  ".join(problems))
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,246 @@
+"""Per-stage throughput + peak memory of the whole pipeline on fixtures, checked against a stored baseline.
+
+    python benchmarks/bench_pipeline.py                      # 20k synthetic facilities, compare with baseline.json
+    python benchmarks/bench_pipeline.py --scale 100000 --stages parse clean_address save
+    python benchmarks/bench_pipeline.py --fixtures benchmarks/fixtures/recorded.sqlite
+    python benchmarks/bench_pipeline.py --error-rate 0.05 --garbage-rate 0.01   # fetch under injected faults
+    python benchmarks/bench_pipeline.py --save-baseline      # after an intended change
+
+Stages: load_ids (load_ids_from_col_b, cold + from the ID sidecar), fetch (fetch_many -> fetch_with_reason against
+the stub serving the fixtures), parse (parse_data), clean_address (clean_bg_address on every fulladdress,
+no cache), address_index (AddressIndex canonical IDs + the Unique_Addresses table, no memo), save
+(save_multisheet_excel), registry (RegistryStore.upsert). Each stage runs in its own process; "stage MB"
+is how far its peak RSS rose above the RSS once the fixtures were loaded. A stage more than --tolerance slower,
+or growing more than that (and more than MEMORY_NOISE_MB), compared with the baseline fails the run.
+The baseline is only comparable on the same machine and scale - re-record it when either changes.
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import main  # noqa: E402
+from fixtures import ensure_synthetic, fixture_ids, load_fixture  # noqa: E402
+
+BASELINE_FILE = os.path.join(HERE, "baseline.json")
+STAGES = ["load_ids", "fetch", "parse", "clean_address", "address_index", "save", "registry"]
+RESULT_PREFIX = "BENCH_RESULT "
+MEMORY_NOISE_MB = 16
+MIN_TIMED_SECONDS = 0.5 # Anything quicker (the warm ID sidecar) is all timer noise - reported, never judged
+
+
+def _rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return main._peak_rss_mb()
+
+
+def _emit(stage, items, seconds, rss_before, **extra):
+    peak = main._peak_rss_mb()
+    print(RESULT_PREFIX + json.dumps(dict(stage=stage, items=items, seconds=round(seconds, 3),
+                                          items_per_s=round(items / seconds, 1) if seconds else 0.0,
+                                          peak_rss_mb=round(peak, 1), stage_rss_mb=round(max(peak - rss_before, 0), 1),
+                                          **extra), ensure_ascii=False), flush=True)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _parsed(corpus):
+    hospitals, addresses, doctors = [], [], []
+    for _, data in corpus:
+        main.parse_data(data, hospitals, addresses, doctors)
+    return hospitals, addresses, doctors
+
+
+def run_stage(stage, args, workdir):
+    """Child side: set up untimed, time only the stage itself."""
+    if stage == "load_ids":
+        from openpyxl import Workbook
+        corpus_ids = fixture_ids(args.fixtures)[:args.limit]
+        path = os.path.join(workdir, "ids.xlsx")
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Sheet1")
+        ws.append(["oldNumber", "number", "name", "Is it parsed"])
+        for id_val in corpus_ids:
+            ws.append([id_val[:6], id_val, "МЦ", ""])
+        wb.save(path)
+        for label in ("load_ids_cold", "load_ids_warm"): # 1st run parses the workbook, 2nd hits the sidecar
+            rss = _rss_mb()
+            t0 = time.perf_counter()
+            ids = main.load_ids_from_col_b(path)
+            _emit(label, len(ids), time.perf_counter() - t0, rss)
+        return
+
+    corpus = load_fixture(args.fixtures, args.limit)
+    if stage == "fetch":
+        ids = [id_val for id_val, _ in corpus[:args.fetch_ids]]
+        port = _free_port()
+        stub = subprocess.Popen([sys.executable, os.path.join(HERE, "stub_api.py"), "--port", str(port), "--rate", "0",
+                                 "--latency", str(args.latency), "--fixtures", args.fixtures, "--seed", "15",
+                                 "--error-rate", str(args.error_rate), "--garbage-rate", str(args.garbage_rate),
+                                 "--slow-rate", str(args.slow_rate)], stdout=subprocess.PIPE, text=True)
+        try:
+            stub.stdout.readline() # "Stub API on ..." = listening
+            main.API_URL = f"http://127.0.0.1:{port}/api/V1/outpatientcare/getOutpatientCareByNumberForApiV1"
+            session = main.make_session(args.concurrency)
+            rss = _rss_mb()
+            t0 = time.perf_counter()
+            ok = sum(1 for _, data, _ in main.fetch_many(ids, session, None, args.concurrency) if data)
+            seconds = time.perf_counter() - t0
+            session.close()
+        finally:
+            stub.terminate()
+            stub.wait()
+        _emit("fetch", len(ids), seconds, rss, ok=ok, concurrency=args.concurrency, latency=args.latency,
+              p50_ms=round(main.METRICS.recent_percentile('fetch', 0.5, len(ids)) * 1000, 1),
+              p99_ms=round(main.METRICS.recent_percentile('fetch', 0.99, len(ids)) * 1000, 1),
+              counters=dict(main.METRICS.counters))
+    elif stage == "parse":
+        rss = _rss_mb()
+        t0 = time.perf_counter()
+        tables = _parsed(corpus)
+        _emit("parse", len(corpus), time.perf_counter() - t0, rss, rows=sum(len(t) for t in tables))
+    elif stage == "clean_address":
+        addresses = [ad.get('fulladdress', '') for _, data in corpus for rec in data for ad in rec.get('address') or []]
+        rss = _rss_mb()
+        t0 = time.perf_counter()
+        for raw in addresses:
+            main.clean_bg_address(raw)
+        _emit("clean_address", len(addresses), time.perf_counter() - t0, rss, distinct=len(set(addresses)))
+    elif stage == "address_index":
+        addresses = [row for row in _parsed(corpus)[1] if row.get('Address_ID')]
+        index = main.AddressIndex(maxsize=0) # Every row pays for its key, like the worst case of all-distinct input
+        rss = _rss_mb()
+        t0 = time.perf_counter()
+        for row in addresses:
+            row['Address_ID'] = index.address_id(row['Full_Address_Clean'], row['City'], row['Region'], row['Municipality'])
+        unique = list(main.AddressIndex.unique_rows(addresses))
+        _emit("address_index", len(addresses), time.perf_counter() - t0, rss, distinct=len(unique))
+    elif stage == "save":
+        tables = _parsed(corpus)
+        rss = _rss_mb()
+        t0 = time.perf_counter()
+        main.save_multisheet_excel(*tables, output_file=os.path.join(workdir, "out.xlsx"))
+        _emit("save", sum(len(t) for t in tables), time.perf_counter() - t0, rss,
+              mb=round(os.path.getsize(os.path.join(workdir, "out.xlsx")) / 1e6, 1))
+    elif stage == "registry":
+        registry = main.RegistryStore(os.path.join(workdir, "registry.sqlite"))
+        rss = _rss_mb()
+        t0 = time.perf_counter()
+        for _, data in corpus:
+            registry.upsert(data)
+        registry.close()
+        _emit("registry", len(corpus), time.perf_counter() - t0, rss)
+
+
+def spawn(stage, args, passthrough):
+    """Parent side: one child per stage, results come back as RESULT_PREFIX lines."""
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", stage, "--fixtures", args.fixtures] + passthrough,
+                          capture_output=True, text=True)
+    results = [json.loads(line[len(RESULT_PREFIX):]) for line in proc.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if proc.returncode or not results:
+        print(f"{stage}: child failed (exit {proc.returncode})\n{proc.stdout[-2000:]}{proc.stderr[-2000:]}")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints the table; returns the stages that regressed."""
+    regressions = []
+    print(f"{'stage':<15}{'items':>9}{'seconds':>10}{'items/s':>12}{'peak MB':>10}{'stage MB':>10}   vs baseline")
+    for r in results:
+        base = baseline.get(r['stage'])
+        verdict = ""
+        if base:
+            speed = r['items_per_s'] / base['items_per_s'] if base['items_per_s'] else 1.0
+            grown = r['stage_rss_mb'] - base['stage_rss_mb']
+            verdict = f"x{speed:.2f} speed, {grown:+.1f} MB"
+            # Memory: relative growth of what the stage itself added, ignoring the few-MB noise of the allocator
+            if (speed < 1 - tolerance and r['seconds'] >= MIN_TIMED_SECONDS) or grown > max(base['stage_rss_mb'] * tolerance, MEMORY_NOISE_MB):
+                regressions.append(r['stage'])
+                verdict += "  <-- REGRESSION"
+        print(f"{r['stage']:<15}{r['items']:>9}{r['seconds']:>10.2f}{r['items_per_s']:>12.0f}"
+              f"{r['peak_rss_mb']:>10.1f}{r['stage_rss_mb']:>10.1f}   {verdict}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", type=int, default=20000, help="synthetic facilities (ignored with --fixtures)")
+    parser.add_argument("--fixtures", help="fixture file (default: benchmarks/fixtures/synthetic_<scale>.sqlite)")
+    parser.add_argument("--limit", type=int, help="use only the first N fixtures")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--fetch-ids", type=int, default=2000, help="fetch: IDs requested from the stub")
+    parser.add_argument("--concurrency", type=int, default=main.CONCURRENCY)
+    parser.add_argument("--latency", type=float, default=0.005, help="fetch: stub latency (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--garbage-rate", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per stage, the best one counts")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown / memory growth vs baseline")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--child", choices=STAGES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+            run_stage(args.child, args, workdir)
+        sys.exit(0)
+
+    args.fixtures = args.fixtures or ensure_synthetic(args.scale)
+    passthrough = ["--fetch-ids", str(args.fetch_ids), "--concurrency", str(args.concurrency), "--latency", str(args.latency),
+                   "--error-rate", str(args.error_rate), "--garbage-rate", str(args.garbage_rate), "--slow-rate", str(args.slow_rate)]
+    if args.limit:
+        passthrough += ["--limit", str(args.limit)]
+    corpus_label = os.path.basename(args.fixtures) + (f"[:{args.limit}]" if args.limit else "")
+    print(f"fixtures: {corpus_label}")
+
+    # Best of --repeat runs per stage: shared CI boxes / laptops jitter by 20-30% run to run
+    best = {}
+    for stage in args.stages:
+        for _ in range(args.repeat):
+            for r in spawn(stage, args, passthrough):
+                if r['stage'] not in best or r['items_per_s'] > best[r['stage']]['items_per_s']:
+                    best[r['stage']] = dict(r, stage_rss_mb=min(r['stage_rss_mb'], best.get(r['stage'], r)['stage_rss_mb']))
+                else:
+                    best[r['stage']]['stage_rss_mb'] = min(r['stage_rss_mb'], best[r['stage']]['stage_rss_mb'])
+    results = list(best.values())
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            stored = json.load(f)
+        if stored.get("fixtures") == corpus_label:
+            baseline = stored["stages"]
+        else:
+            print(f"baseline is for {stored.get('fixtures')}, not {corpus_label} - not comparing")
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        stored = {"fixtures": corpus_label, "recorded": time.strftime("%Y-%m-%d"),
+                  "machine": f"{platform.machine()} {os.cpu_count()} cpu, Python {platform.python_version()}",
+                  "stages": {r['stage']: {k: r[k] for k in ('items', 'seconds', 'items_per_s', 'peak_rss_mb', 'stage_rss_mb')} for r in results}}
+        if os.path.exists(args.baseline): # Keep stages this run skipped
+            with open(args.baseline, encoding="utf-8") as f:
+                old = json.load(f)
+            if old.get("fixtures") == corpus_label:
+                stored["stages"] = dict(old["stages"], **stored["stages"])
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(stored, f, ensure_ascii=False, indent=2)
+        print(f"baseline saved -> {args.baseline}")
+    elif regressions:
+        print(f"REGRESSED: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,59 @@
+"""Golden check + keys/sec for AddressIndex (the canonical Address_ID behind Unique_Addresses).
+
+    python benchmarks/check_address_index.py
+
+SAME groups must collapse to one Address_ID, DIFFERENT groups must not share one (all under one ekatte/district/
+municipality). Any miss fails the run. Changing the key logic re-keys every ID - bump main.ADDRESS_INDEX_VERSION.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+PLACE = ("68134", "София (столица)", "Столична")
+
+SAME = [
+    ["гр. София, ул. Гладстон 5А", "улица  Гладстон 5 а", "ул.Гладстон № 5а", "УЛ. ГЛАДСТОН 5А", "гр. София ул. Гладстон 5А"],
+    ["гр. Пловдив ул. Марица 12", "гр. Пловдив, ул. Марица 12", "ул. Марица 12"],
+    ["гр. София, ж.к. Младост 1, бл. 5", "ж. к. Младост 1 блок 5", "жилищен комплекс Младост-1, бл.5"],
+    ["бул. България 12", "булевард \"България\" 12", "гр. София бул. България 12"],
+    ["с. Горна баня ул. Първа 3", "село Горна баня, улица Първа 3", "ул. Първа 3"],
+]
+
+DIFFERENT = [
+    # The settlement name ends at a street marker, not at the first comma
+    ["гр. София ул. Гладстон 5, 2", "гр. София бул. Витоша 10, 2", "гр. София, 2"],
+    ["гр. София ж.к. Люлин 3, 25", "гр. София ж.к. Младост 1, 25"],
+    # No street part left -> the prefix stays
+    ["гр. София", "гр. Пловдив", "с. Горна баня"],
+]
+
+
+def address_id(index, clean):
+    return index.address_id(clean, *PLACE)
+
+
+if __name__ == "__main__":
+    index = main.AddressIndex(maxsize=0)
+    failures = []
+    for group in SAME:
+        ids = {address_id(index, a) for a in group}
+        if len(ids) != 1:
+            failures.append(f"SPLIT {group}: {[index.normalize(a) for a in group]}")
+    for group in DIFFERENT:
+        ids = [address_id(index, a) for a in group]
+        if len(set(ids)) != len(ids):
+            failures.append(f"MERGED {group}: {[index.normalize(a) for a in group]}")
+    for failure in failures:
+        print(failure)
+
+    corpus = [a for group in SAME + DIFFERENT for a in group] * 2000
+    t0 = time.perf_counter()
+    for clean in corpus:
+        address_id(index, clean)
+    print(f"golden: {len(SAME)} same / {len(DIFFERENT)} different groups, {len(failures)} failures")
+    print(f"uncached keys: {len(corpus) / (time.perf_counter() - t0):10.0f} addresses/sec")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,242 @@
+"""Recorded and synthetic API responses for the benchmarks and the stub API.
+
+    python benchmarks/fixtures.py --synthetic 100000                     # -> benchmarks/fixtures/synthetic_100000.sqlite
+    python benchmarks/fixtures.py --record raw_responses.sqlite --limit 5000 --out benchmarks/fixtures/recorded.sqlite
+
+Fixture files use the raw store layout (id, fetched_at, zlib-compressed JSON body), so main.RawStore can read
+them and the stub can serve them. Synthetic records are deterministic per ID and mimic the real fan-out:
+mostly single-doctor GP practices, a tail of DKC/medical centres with dozens of doctors, polyclinic campus
+addresses shared by many practices and doctors who work at several facilities.
+"""
+import argparse
+import functools
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import zlib
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# (district, municipality, ekatte, settlement) with a rough weight by number of practices
+PLACES = [
+    ("София (столица)", "Столична", "68134", "гр. София", 30),
+    ("Пловдив", "Пловдив", "56784", "гр. Пловдив", 10),
+    ("Варна", "Варна", "10135", "гр. Варна", 9),
+    ("Бургас", "Бургас", "07079", "гр. Бургас", 6),
+    ("Русе", "Русе", "63427", "гр. Русе", 4),
+    ("Стара Загора", "Стара Загора", "68850", "гр. Стара Загора", 4),
+    ("Плевен", "Плевен", "56722", "гр. Плевен", 4),
+    ("Благоевград", "Благоевград", "04279", "гр. Благоевград", 2),
+    ("Велико Търново", "Велико Търново", "10447", "гр. Велико Търново", 2),
+    ("Шумен", "Шумен", "83510", "гр. Шумен", 2),
+    ("Пловдив", "Марица", "61916", "с. Рогош", 1),
+    ("София", "Самоков", "65231", "гр. Самоков", 1),
+    ("Хасково", "Хасково", "77195", "гр. Хасково", 2),
+    ("Габрово", "Габрово", "14218", "гр. Габрово", 1),
+    ("Видин", "Видин", "10971", "гр. Видин", 1),
+]
+PLACE_WEIGHTS = [p[4] for p in PLACES]
+
+# (vid label, weight, owners range, addresses range, staff range)
+FACILITY_KINDS = [
+    ("Индивидуална практика за първична медицинска помощ", 40, (1, 1), (1, 2), (1, 2)),
+    ("Индивидуална практика за специализирана медицинска помощ", 25, (1, 1), (1, 2), (1, 1)),
+    ("Индивидуална практика за първична помощ по дентална медицина", 15, (1, 1), (1, 1), (1, 2)),
+    ("Групова практика за специализирана медицинска помощ", 8, (2, 4), (1, 3), (2, 6)),
+    ("Медицински център", 7, (0, 3), (1, 4), (5, 40)),
+    ("Дентален център", 3, (0, 2), (1, 2), (3, 15)),
+    ("Диагностично-консултативен център", 2, (0, 2), (1, 3), (20, 120)),
+]
+KIND_WEIGHTS = [k[1] for k in FACILITY_KINDS]
+
+SPECIALTIES = [
+    "Обща медицина", "Кардиология", "Педиатрия", "Неврология", "Дерматология и венерология", "Акушерство и гинекология",
+    "Ортопедия и травматология", "Очни болести", "Ушно-носно-гърлени болести", "Вътрешни болести", "Ендокринология и болести на обмяната",
+    "Гастроентерология", "Пневмология и фтизиатрия", "Урология", "Хирургия", "Психиатрия", "Нефрология", "Ревматология",
+    "Физикална и рехабилитационна медицина", "Образна диагностика", "Клинична лаборатория", "Алергология", "Онкология",
+    "Обща дентална медицина", "Ортодонтия", "Детска дентална медицина", "Пародонтология", "Инфекциозни болести",
+]
+ACTIVITIES = ["Първична медицинска помощ", "Специализирана медицинска помощ", "Първична дентална помощ",
+              "Специализирана дентална помощ", "Медико-диагностична дейност"]
+FIRST = ["Иван", "Мария", "Георги", "Елена", "Димитър", "Надежда", "Петър", "Анна", "Николай", "Цветелина", "Стефан",
+         "Десислава", "Христо", "Росица", "Тодор", "Милена", "Васил", "Светлана", "Калин", "Валентина", "Борис", "Теодора"]
+MIDDLE = ["Иванов", "Петров", "Георгиев", "Димитров", "Стоянов", "Николов", "Христов", "Тодоров", "Колев", "Ангелов",
+          "Атанасов", "Илиев", "Павлов", "Стефанов", "Борисов", "Любенов", "Найденов", "Кирилов"]
+LAST = ["Иванов", "Петров", "Георгиев", "Димитров", "Стоянов", "Николов", "Христов", "Тодоров", "Колев", "Ангелов",
+        "Маринов", "Попов", "Василев", "Костов", "Михайлов", "Янков", "Йорданов", "Русев", "Лазаров", "Симеонов",
+        "Добрев", "Младенов", "Станчев", "Генчев", "Радев", "Пеев", "Кръстев", "Занев", "Цонев", "Велев",
+        "Манолов", "Кацаров", "Бояджиев", "Узунов", "Чолаков", "Шопов", "Гочев", "Дамянов", "Ников", "Желев"]
+STREETS = ["ул. Иван Вазов", "бул. България", "ул. Гладстон", "ж.к. Тракия", "бул. Христо Ботев", "ул. Раковски",
+           "бул. Цар Освободител", "ул. Шипка", "ж.к. Младост 1", "ул. Васил Левски", "бул. Македония", "ул. Опълченска"]
+EXTRAS = ["", "", "ет. 2, каб. 5", "ДКЦ 1, каб. 12", "(до аптеката)", "вх. А, ап. 3", "МБАЛ Св. Анна, етаж 4",
+          "Поликлиника, ет. 3", "№ 2", "офис 4"]
+
+CAMPUS_SHARE = 0.3  # Chance an address is one of the shared polyclinic / DKC campus buildings
+CAMPUSES_PER_FACILITY = 0.02  # Campus pool size relative to the corpus
+DOCTORS_PER_FACILITY = 0.6  # Doctor pool size relative to the corpus (the rest of the staff slots repeat doctors)
+
+
+def _feminine(surname, female):
+    return surname + "а" if female and surname.endswith(("ов", "ев")) else surname
+
+
+def _person(rnd):
+    first = rnd.choice(FIRST)
+    female = first.endswith("а")
+    return {"firstname": first, "middlename": _feminine(rnd.choice(MIDDLE), female),
+            "lastname": _feminine(rnd.choice(LAST), female)}
+
+
+@functools.lru_cache(maxsize=None)
+def _campus_address(index):
+    rnd = random.Random(f"campus-{index}")
+    place = rnd.choices(PLACES, PLACE_WEIGHTS)[0]
+    return place, f"{place[3]}, {rnd.choice(STREETS)} № {rnd.randint(1, 200)}, {rnd.choice(EXTRAS[5:])}"
+
+
+@functools.lru_cache(maxsize=None)
+def _doctor(index):
+    rnd = random.Random(f"doctor-{index}")
+    doctor = _person(rnd)
+    doctor["typelabel"] = "Лекар по дентална медицина" if rnd.random() < 0.2 else "Лекар"
+    doctor["specialities"] = [{"label": s} for s in rnd.sample(SPECIALTIES, rnd.choice((1, 1, 1, 2, 2, 3)))]
+    return doctor
+
+
+def synthetic_record(id_number, scale=100000):
+    """Deterministic fake facility for an ID. `scale` sizes the shared campus/doctor pools like a corpus of that many."""
+    rnd = random.Random(f"facility-{id_number}")
+    vid, _, owners_range, addresses_range, staff_range = rnd.choices(FACILITY_KINDS, KIND_WEIGHTS)[0]
+    addresses = []
+    for _ in range(rnd.randint(*addresses_range)):
+        if rnd.random() < CAMPUS_SHARE:
+            place, full = _campus_address(rnd.randrange(max(1, int(scale * CAMPUSES_PER_FACILITY))))
+        else:
+            place = rnd.choices(PLACES, PLACE_WEIGHTS)[0]
+            full = f"{place[3]}, {rnd.choice(STREETS)} № {rnd.randint(1, 200)}, {rnd.choice(EXTRAS)}".rstrip(", ")
+        addresses.append({
+            "typeaddresslabel": rnd.choice(["Адрес на дейност", "Адрес на управление"]),
+            "ekatte": place[2],
+            "fulladdress": full,
+            "specialities": [{"label": s} for s in rnd.sample(SPECIALTIES, rnd.randint(0, 4))],
+            "activities": [{"label": a} for a in rnd.sample(ACTIVITIES, rnd.randint(1, 2))],
+            "district": place[0],
+            "munincipaliti": place[1],
+        })
+    pool = max(1, int(scale * DOCTORS_PER_FACILITY))
+    # Squaring skews towards low indices: a few doctors show up at many facilities, most at one
+    staff = [_doctor(int(pool * rnd.random() ** 2)) for _ in range(rnd.randint(*staff_range))]
+    return {
+        "number": str(id_number),
+        "oldNumber": str(id_number)[:10],
+        "name": f"{vid.split()[0]} {rnd.choice(LAST)} {rnd.randint(1, 999)} ЕООД",
+        "statuslabel": "Заличен" if rnd.random() < 0.05 else "Действащ",
+        "registrationDate": f"{rnd.randint(2000, 2025)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}",
+        "vid": {"label": vid},
+        "owners": [_person(rnd) for _ in range(rnd.randint(*owners_range))],
+        "address": addresses,
+        "medicalStaff": staff,
+    }
+
+
+def synthetic_ids(count):
+    """Registry-looking 10-digit numbers."""
+    return [str(2200000000 + i * 7) for i in range(count)]
+
+
+def _open(path):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, fetched_at REAL, body BLOB)")
+    return db
+
+
+def write_synthetic(path, count):
+    db = _open(path)
+    db.execute("DELETE FROM responses")
+    now = time.time()
+    ids = synthetic_ids(count)
+    for start in range(0, count, 5000):
+        db.executemany("INSERT INTO responses VALUES (?, ?, ?)", [
+            (id_number, now, zlib.compress(json.dumps([synthetic_record(id_number, count)], ensure_ascii=False,
+                                                      separators=(',', ':')).encode('utf-8')))
+            for id_number in ids[start:start + 5000]])
+    db.commit()
+    db.close()
+
+
+def record_from_raw_store(raw_store, path, limit=None):
+    """Copies real responses out of a raw store (see main.RawStore) into a fixture file."""
+    db = _open(path)
+    db.execute("DELETE FROM responses")
+    db.execute("ATTACH DATABASE ? AS raw", (raw_store,))
+    db.execute("INSERT INTO responses SELECT id, fetched_at, body FROM raw.responses ORDER BY id LIMIT ?",
+               (-1 if limit is None else limit,))
+    db.commit()
+    db.execute("DETACH DATABASE raw")
+    db.close()
+
+
+def ensure_synthetic(count):
+    """Path of the cached synthetic fixture of this size, generated on first use."""
+    os.makedirs(FIXTURES_DIR, exist_ok=True)
+    path = os.path.join(FIXTURES_DIR, f"synthetic_{count}.sqlite")
+    if not os.path.exists(path):
+        t0 = time.perf_counter()
+        write_synthetic(path + ".tmp", count)
+        os.replace(path + ".tmp", path)
+        print(f"generated {count} synthetic facilities in {time.perf_counter() - t0:.1f}s -> {path}")
+    return path
+
+
+def fixture_ids(path):
+    db = sqlite3.connect(path)
+    ids = [row[0] for row in db.execute("SELECT id FROM responses ORDER BY id")]
+    db.close()
+    return ids
+
+
+def load_fixture(path, limit=None):
+    """[(id, response), ...] in ID order."""
+    db = sqlite3.connect(path)
+    rows = db.execute("SELECT id, body FROM responses ORDER BY id LIMIT ?", (-1 if limit is None else limit,)).fetchall()
+    db.close()
+    return [(id_val, json.loads(zlib.decompress(body))) for id_val, body in rows]
+
+
+class FixtureFactory:
+    """record_factory for the stub API: serves recorded bodies by ID, None (-> 404) for unknown IDs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()  # The stub answers from a thread per request
+
+    def __call__(self, id_number):
+        with self.lock:
+            row = self.db.execute("SELECT body FROM responses WHERE id = ?", (id_number,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--synthetic", type=int, help="generate this many synthetic facilities")
+    parser.add_argument("--record", metavar="RAW_STORE", help="copy real responses out of a raw store")
+    parser.add_argument("--limit", type=int, help="--record: at most this many responses")
+    parser.add_argument("--out", help="fixture file (default: benchmarks/fixtures/synthetic_<N>.sqlite)")
+    args = parser.parse_args()
+    if args.record:
+        out = args.out or os.path.join(FIXTURES_DIR, "recorded.sqlite")
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+        record_from_raw_store(args.record, out, args.limit)
+        print(f"recorded {len(fixture_ids(out))} responses -> {out}")
+    elif args.synthetic:
+        if args.out:
+            write_synthetic(args.out, args.synthetic)
+            print(f"generated {args.synthetic} synthetic facilities -> {args.out}")
+        else:
+            ensure_synthetic(args.synthetic)
+    else:
+        parser.error("nothing to do: pass --synthetic N or --record RAW_STORE")
@@ -0,0 +1,94 @@
+"""Runs N scrape shards as separate processes against the stub API, merges them and checks nothing was lost.
+
+    python benchmarks/run_shards.py --shards 4 --ids 200
+
+Everything happens in a scratch copy of main.py (all paths are relative to the script), so the real
+progress logs are never touched.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from stub_api import start_in_thread
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_workspace(n_ids):
+    workdir = tempfile.mkdtemp(prefix="shards_")
+    shutil.copy2(os.path.join(ROOT, "main.py"), workdir)
+    ids = [f"{i:012d}" for i in range(1, n_ids + 1)]
+    ids[3] = "404000000001" # One real 404 for the failed log
+    pd.DataFrame({'oldNumber': ids, 'number': ids}).to_excel(
+        os.path.join(workdir, "BG_Medical_Registry_Remaining.xlsx"), index=False)
+    return workdir, ids
+
+
+def run(workdir, args, env):
+    return subprocess.Popen([sys.executable, "main.py", *args], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--ids", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=0, help="stub WAF threshold, req/s (0 = unlimited)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    server, api_url = start_in_thread(rate=args.rate, latency=0.05)
+    workdir, ids = make_workspace(args.ids)
+    env = dict(os.environ, SCRAPER_API_URL=api_url, SCRAPER_RATE_START="10", SCRAPER_RATE_MAX="20")
+
+    t0 = time.perf_counter()
+    procs = [run(workdir, ["--shard-index", str(i), "--shard-count", str(args.shards)], env) for i in range(args.shards)]
+    for i, proc in enumerate(procs):
+        _, err = proc.communicate()
+        if proc.returncode:
+            sys.exit(f"shard {i} died:\n{err}")
+    print(f"{args.shards} shards done in {time.perf_counter() - t0:.1f}s")
+
+    merge = run(workdir, ["merge"], env)
+    _, err = merge.communicate()
+    if merge.returncode:
+        sys.exit(f"merge died:\n{err}")
+
+    with open(os.path.join(workdir, "processed_ids.txt"), encoding="utf-8") as f:
+        done = [line.strip() for line in f if line.strip()]
+    with open(os.path.join(workdir, "failed_ids.txt"), encoding="utf-8") as f:
+        failed = [line.split("\t")[0] for line in f if line.strip()]
+    books = [n for n in os.listdir(workdir) if n.startswith("FINAL_DOCTORS_BATCH_")]
+    hospitals = pd.read_excel(os.path.join(workdir, books[0]), sheet_name="Hospitals", dtype=str)
+
+    problems = []
+    if len(done) != len(set(done)):
+        problems.append("duplicate IDs in processed_ids.txt")
+    if sorted(done + failed) != sorted(ids):
+        problems.append(f"settled {len(done) + len(failed)} of {len(ids)} IDs")
+    if set(hospitals["Hospital_ID"]) != set(done):
+        problems.append("merged workbook does not match processed_ids.txt")
+    with sqlite3.connect(os.path.join(workdir, "registry.sqlite")) as db:
+        registry_ids = {row[0] for row in db.execute("SELECT id FROM hospitals")}
+    if registry_ids != set(done):
+        problems.append(f"registry has {len(registry_ids)} facilities, expected {len(done)}")
+    # Address caches and perf reports stay per shard on purpose (each runner restores / reports its own)
+    leftovers = [n for n in os.listdir(workdir) if ".shard-" in n and not n.startswith(("address_cache", "PERF_REPORT_"))]
+    if len(books) != 1 or leftovers:
+        problems.append(f"shard leftovers after merge: {leftovers}")
+
+    print(f"merged: {len(done)} done, {len(failed)} failed, {len(hospitals)} hospital rows in {books[0]}")
+    print("OK" if not problems else "PROBLEMS:\n  " + "\n  ".join(problems))
+    if args.keep:
+        print(f"workspace: {workdir}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    server.shutdown()
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,174 @@
+"""Local stand-in for registries.his.bg so the scraper can be run without touching the real WAF.
+
+    python benchmarks/stub_api.py --port 8765 --rate 5
+    SCRAPER_API_URL=http://127.0.0.1:8765/api/V1/outpatientcare/getOutpatientCareByNumberForApiV1 python main.py
+
+The throttle is a server-side token bucket: go faster than --rate and you eat a 429 with Retry-After,
+just like the real thing when it gets salty. On top of that, faults can be injected: --error-rate (503s),
+--garbage-rate (200 with an HTML page instead of JSON) and --slow-rate (answers after --slow-latency, i.e. a
+client timeout). Bodies come from --fixtures (see fixtures.py), the realistic --synthetic generator, or
+the tiny fake_record below.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ENDPOINT = "/api/V1/outpatientcare/getOutpatientCareByNumberForApiV1"
+
+
+def fake_record(id_number):
+    """Deterministic fake facility for an ID (same ID -> same JSON)."""
+    rnd = random.Random(zlib.crc32(str(id_number).encode()))
+    streets = ["ул. Иван Вазов", "бул. България", "ул. Гладстон", "ж.к. Тракия", "пл. Съединение"]
+    extras = ["ет. 2, каб. 5", "ДКЦ 1, каб. 12", "(до аптеката)", "вх. А, ап. 3", "", "МБАЛ Св. Анна, етаж 4"]
+    specs = ["Кардиология", "Обща медицина", "Педиатрия", "Дерматология", "Неврология"]
+    return {
+        "number": str(id_number),
+        "oldNumber": str(id_number)[:10],
+        "name": f"МЦ Стъб {rnd.randint(1, 999)} ЕООД",
+        "statuslabel": "Действащ",
+        "registrationDate": "2020-01-01",
+        "vid": {"label": "Медицински център"},
+        "owners": [
+            {"firstname": "Иван", "middlename": "Петров", "lastname": f"Стъбов{i}"}
+            for i in range(rnd.randint(0, 2))
+        ],
+        "address": [
+            {
+                "typeaddresslabel": "Адрес на дейност",
+                "ekatte": str(rnd.choice([68134, 56784, 10135])),
+                "fulladdress": f"гр. София, {rnd.choice(streets)} № {rnd.randint(1, 120)}, {rnd.choice(extras)}",
+                "specialities": [{"label": s} for s in rnd.sample(specs, rnd.randint(0, 3))],
+                "activities": [{"label": "Специализирана медицинска помощ"}],
+                "district": "София (столица)",
+                "munincipaliti": "Столична",
+            }
+            for _ in range(rnd.randint(1, 3))
+        ],
+        "medicalStaff": [
+            {
+                "firstname": "Мария",
+                "middlename": "Георгиева",
+                "lastname": f"Докторова{i}",
+                "typelabel": "Лекар",
+                "specialities": [{"label": s} for s in rnd.sample(specs, rnd.randint(1, 2))],
+            }
+            for i in range(rnd.randint(0, 6))
+        ],
+    }
+
+
+class Throttle:
+    """Server-side token bucket (the fake WAF)."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.rejected = 0
+        self.served = 0
+
+    def allow(self):
+        if self.rate <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.served += 1
+                return True
+            self.rejected += 1
+            return False
+
+
+def make_server(port=0, rate=5.0, burst=2.0, latency=0.15, record_factory=fake_record,
+                error_rate=0.0, garbage_rate=0.0, slow_rate=0.0, slow_latency=15.0, seed=None):
+    throttle = Throttle(rate, burst)
+    faults = random.Random(seed)
+    fault_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != ENDPOINT:
+                return self._send(404, b"{}")
+            with fault_lock:
+                roll = faults.random()
+            time.sleep(slow_latency if roll < slow_rate else latency * random.uniform(0.5, 1.5))
+            if not throttle.allow():
+                return self._send(429, b'{"error": "slow down"}', {"Retry-After": "1"})
+            roll -= slow_rate
+            if 0 <= roll < error_rate:
+                server.injected += 1
+                return self._send(503, b'{"error": "maintenance"}')
+            roll -= error_rate
+            if 0 <= roll < garbage_rate:
+                server.injected += 1
+                return self._send(200, b"<html><body>Request rejected</body></html>")
+            number = parse_qs(url.query).get("number", [""])[0]
+            record = record_factory(number) if number and not number.startswith("404") else None
+            if record is None:
+                return self._send(404, b"{}")
+            self._send(200, json.dumps(record, ensure_ascii=False).encode("utf-8"))
+
+        def _send(self, status, body, extra_headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (extra_headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.throttle = throttle
+    server.injected = 0
+    return server
+
+
+def start_in_thread(**kwargs):
+    """Starts the stub on a free port; returns (server, api_url)."""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}{ENDPOINT}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=float, default=5.0, help="allowed req/s before 429 (0 = unlimited)")
+    parser.add_argument("--burst", type=float, default=2.0)
+    parser.add_argument("--latency", type=float, default=0.15, help="mean response latency in seconds")
+    parser.add_argument("--fixtures", help="serve recorded/synthetic bodies from this fixture file (unknown IDs -> 404)")
+    parser.add_argument("--synthetic", type=int, metavar="SCALE", help="realistic generated bodies, pools sized for SCALE facilities")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with a 503")
+    parser.add_argument("--garbage-rate", type=float, default=0.0, help="share answered 200 with HTML instead of JSON")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share answered only after --slow-latency")
+    parser.add_argument("--slow-latency", type=float, default=15.0)
+    parser.add_argument("--seed", type=int, help="fault injection seed")
+    args = parser.parse_args()
+    if args.fixtures:
+        from fixtures import FixtureFactory
+        factory = FixtureFactory(args.fixtures)
+    elif args.synthetic:
+        from fixtures import synthetic_record
+        factory = lambda number: synthetic_record(number, args.synthetic)  # noqa: E731
+    else:
+        factory = fake_record
+    srv = make_server(args.port, args.rate, args.burst, args.latency, factory, args.error_rate,
+                      args.garbage_rate, args.slow_rate, args.slow_latency, args.seed)
+    print(f"Stub API on http://127.0.0.1:{srv.server_address[1]}{ENDPOINT} (rate={args.rate}/s)", flush=True)
+    srv.serve_forever()
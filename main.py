@@ -1,29 +1,114 @@
 import requests
 import pandas as pd
+import numpy as np
 import os
 import time
 import random
 import sys
 import shutil
 import re
+import json
+import glob
+import argparse
+import threading
+import sqlite3
+import hashlib
+import zlib
+import csv
+import io
+import signal
+import functools
+from array import array
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+try:
+    import resource # Peak RSS reporting - POSIX only
+except ImportError:
+    resource = None
+from requests.adapters import HTTPAdapter
+from openpyxl import Workbook, load_workbook
 
 # --- CONFIGURATION ---
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 INPUT_FILENAME = "BG_Medical_Registry_Remaining.xlsx" 
 INPUT_FILE_PATH = os.path.join(SCRIPT_DIR, INPUT_FILENAME)
 PROCESSED_LOG_FILE = os.path.join(SCRIPT_DIR, "processed_ids.txt") # Тук ще пазим ID-тата на готовите пациентчовци
+FAILED_LOG_FILE = os.path.join(SCRIPT_DIR, "failed_ids.txt") # ID<TAB>причина - отделно от успешните
+RETRY_QUEUE_FILE = os.path.join(SCRIPT_DIR, "retry_queue.json") # Транзиентните провали чакат тук за втори шанс
+RETRY_BASE_DELAY = 30       # Seconds before the 1st retry; doubles every attempt (+ jitter)
+RETRY_MAX_DELAY = 1800
+RETRY_MAX_ATTEMPTS = 6      # Failed fetches before an ID is given up on for good
+RETRY_DRAIN_MAX_WAIT = RETRY_MAX_DELAY # End-of-run drain waits at most this long for the next retry to come due
 CONTINUE_FLAG_FILE = "CONTINUE_FLAG" # Флагче за рестарт
+ID_INDEX_SUFFIX = ".ids" # Sidecar with column B already extracted, keyed by the workbook's hash
 
 # Safety margin: GitHub kills at 6h. We stop at 5h 40m just to be safe.
 # 5 hours * 3600 + 40 mins * 60 = 18000 + 2400 = 20400 seconds.
-MAX_RUNTIME_SECONDS = 20400 
+# The script is fully done (drained, checkpointed, saved) by then - the rest is for the commit/upload steps.
+MAX_RUNTIME_SECONDS = int(os.environ.get("SCRAPER_MAX_RUNTIME_SECONDS", "20400"))
 START_TIME = time.time()
+FINISH_SAFETY_SECONDS = 60 # Slack on top of the learned drain + final save estimate
+SAVE_SECONDS_PER_MB = 1.5 # Final-save cost per MB of part files until the probe measures the real one
+SAVE_SECONDS_PER_DELTA_ROW = 0.0003 # Same for the sync delta workbook (never probed, it stays small)
+SAVE_PROBE_BYTES = 1_000_000 # Probe the save cost once this run's parts reach this size
+SIGNAL_SAVE_GRACE_SECONDS = 5 # On SIGTERM/SIGINT only save the workbook if it fits in this, else parts wait for the next run
 
 # Output file (Dynamic naming to avoid overwriting)
 TIMESTAMP = datetime.now().strftime("%Y%m%d_%H%M%S")
 OUTPUT_FILE = os.path.join(SCRIPT_DIR, f'FINAL_DOCTORS_BATCH_{TIMESTAMP}.xlsx')
 
+# --- STREAMING OUTPUT ---
+# Parsed rows go to append-only JSONL part files as we go, so a killed run still leaves its data on disk.
+PARTS_ROOT = os.path.join(SCRIPT_DIR, "batch_parts")
+PARTS_DIR = os.path.join(PARTS_ROOT, TIMESTAMP)
+SINK_CHUNK_ROWS = 500 # Rows buffered in memory before a part file gets written
+CHECKPOINT_EVERY_IDS = 25 # ...or this many finished IDs
+CHECKPOINT_EVERY_SECONDS = 30 # ...or this much time, whichever comes first
+COMMIT_MARKER = "_commit" # First line of every part file: the IDs whose rows it carries
+
+# Fixed column order per sheet (the old DataFrame-of-dicts order depended on which row came first)
+HOSPITAL_COLUMNS = ['Hospital_ID', 'Old_Number', 'Name', 'Status', 'Reg_Date', 'Vid_LZ', 'Managers']
+ADDRESS_COLUMNS = ['Hospital_ID', 'Type', 'City', 'Full_Address', 'Full_Address_Clean', 'Address_ID',
+                   'Address_Specialties', 'Address_Activities', 'Region', 'Municipality']
+DOCTOR_COLUMNS = ['Hospital_ID', 'Doctor_Name', 'Type', 'Specialty']
+SHEETS = [('Hospitals', HOSPITAL_COLUMNS), ('Addresses', ADDRESS_COLUMNS), ('Doctors', DOCTOR_COLUMNS)]
+
+# --- FETCH ENGINE ---
+# API base can be pointed at a local stub (see benchmarks/stub_api.py) for dry runs.
+API_URL = os.environ.get("SCRAPER_API_URL", "https://registries.his.bg/api/V1/outpatientcare/getOutpatientCareByNumberForApiV1")
+REQUEST_TIMEOUT = 10
+CONCURRENCY = int(os.environ.get("SCRAPER_CONCURRENCY", "4")) # Workers sharing one pooled session
+# Token bucket (requests/sec). Starts polite, backs off on 429/5xx/timeouts, ramps up when the WAF is chill.
+RATE_START = float(os.environ.get("SCRAPER_RATE_START", "2.0"))
+RATE_MIN = float(os.environ.get("SCRAPER_RATE_MIN", "0.5"))
+RATE_MAX = float(os.environ.get("SCRAPER_RATE_MAX", "6.0"))
+RATE_STEP = 0.25     # Additive increase after every RAMP_EVERY healthy responses
+RAMP_EVERY = 10
+BACKOFF_FACTOR = 0.5 # Multiplicative decrease on throttling
+THROTTLE_RETRIES = 3 # In-place retries (after back-off) for 429/5xx/timeouts
+
+# --- ADDRESS CACHE ---
+# Polyclinics/DKC/MBAL campuses repeat the same fulladdress for dozens of practices - clean each one once.
+ADDRESS_CACHE_SIZE = int(os.environ.get("SCRAPER_ADDRESS_CACHE_SIZE", "50000"))
+ADDRESS_CACHE_FILE = os.path.join(SCRIPT_DIR, "address_cache.sqlite") # Survives restarts via actions/cache
+
+# --- ADDRESS INDEX ---
+# Geocoding should pay per distinct location, not per row. Same ekatte/district/municipality + same normalized
+# Full_Address_Clean (case, spacing, "ул."/"улица"/"ул" etc. folded) = same Address_ID, and every workbook gets a
+# compact Unique_Addresses sheet with one row per ID.
+ADDRESS_ID_PREFIX = "ADDR-" # + 12 hex of sha1(key). Changing the key logic re-keys everything - geocode caches go stale
+ADDRESS_INDEX_VERSION = "K2" # Bump when AddressIndex.normalize() changes - the registry re-derives its rows
+UNIQUE_ADDRESS_SHEET = 'Unique_Addresses'
+UNIQUE_ADDRESS_COLUMNS = ['Address_ID', 'City', 'Region', 'Municipality', 'Full_Address_Clean', 'Occurrences']
+
+# --- METRICS ---
+# Per-stage latency histograms + counters, dumped as JSON/CSV next to the batch (uploaded with the artifact).
+PERF_REPORT_FILE = os.path.join(SCRIPT_DIR, f'PERF_REPORT_{TIMESTAMP}.json') # .csv twin gets the stage table
+PROGRESS_EVERY_SECONDS = float(os.environ.get("SCRAPER_PROGRESS_EVERY", "15")) # One status line per this many seconds
+RATE_WINDOW_SECONDS = 120 # Rolling window for the IDs/min rate and the ETA
+
 headers = {
     'accept': '*/*',
     'accept-language': 'en-US,en;q=0.9,bg;q=0.8',
@@ -31,203 +116,1064 @@ headers = {
     'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36 Edg/144.0.0.0'
 }
 
+# --- SHARDING ---
+# Matrix runners each take a deterministic slice of the pending IDs (crc32(ID) % count) and keep their own
+# progress logs / parts / workbook (name.shard-N.ext). `python main.py merge` folds them back together.
+SHARD_INDEX = int(os.environ.get("SCRAPER_SHARD_INDEX", "0"))
+SHARD_COUNT = int(os.environ.get("SCRAPER_SHARD_COUNT", "1"))
+
+# --- RAW RESPONSE STORE ---
+# Every raw JSON answer is kept (compressed), so `python main.py reparse` can rebuild outputs with zero network.
+RAW_STORE_FILE = os.path.join(SCRIPT_DIR, "raw_responses.sqlite")
+REPARSE_PARTS_ROOT = os.path.join(SCRIPT_DIR, "reparse_parts") # Separate from batch_parts - these are not scrape progress
+REPARSE_CHUNK = 250 # Records per worker task
+REPARSED_FILE = os.path.join(SCRIPT_DIR, f'REPARSED_{TIMESTAMP}.xlsx')
+
+# --- REGISTRY DB ---
+# Normalized, deduplicated copy of everything we fetched (one row per facility/owner/doctor/specialty), upserted
+# across runs. The workbooks are just views of it now: `python main.py export`.
+REGISTRY_DB_FILE = os.path.join(SCRIPT_DIR, "registry.sqlite")
+REGISTRY_EXPORT_FILE = os.path.join(SCRIPT_DIR, f'REGISTRY_EXPORT_{TIMESTAMP}.xlsx')
+
+# --- INCREMENTAL SYNC ---
+# `python main.py sync` re-fetches only facilities that are new, changed in the registry listing, or too old.
+SYNC_INPUT_FILE_PATH = os.path.join(SCRIPT_DIR, "BG_Medical_Registry_FULL.xlsx") # Full listing = source of truth for removals
+SYNC_STATE_FILE = os.path.join(SCRIPT_DIR, "sync_state.sqlite") # Last known snapshot per Hospital_ID
+SYNC_MAX_AGE_DAYS = float(os.environ.get("SCRAPER_SYNC_MAX_AGE_DAYS", "30")) # Re-check unchanged listings this often (0 = never)
+SYNC_IGNORED_COLUMNS = {'Is it parsed'} # Hand-maintained columns that say nothing about the facility
+DELTA_FILE = os.path.join(SCRIPT_DIR, f'DELTA_SYNC_{TIMESTAMP}.xlsx')
+DELTA_COLUMNS = ['Facility_Change', 'Change'] # new/changed/removed facility + added/removed row
+
 # --- THE SINGULARITY CLEANER V16 (INTEGRATED & ENRICHED) ---
+CLEANER_VERSION = "V16" # Bump when clean() logic changes - invalidates the on-disk address cache
+# 0. INSTANT KILL (Metadata brainrot)
+# Ако адресът съдържа тези думи и е твърде къс, значи е просто статус, а не локация.
+BRAINROT_INDICATORS = ["ЗАЛИЧЕН", "ЗАКРИТ", "НЕ СЪЩЕСТВУВА", "НЯМА ДАННИ", "ПРИЗЕМЕН", "СУТЕРЕН", "ПОЛИКЛИНИКА", "ЗДРАВНА СЛУЖБА", "СЗС"]
+
+# 3. THE KILL LIST V16 (Updated with industrial, short-form horrors, and enrichments)
+# Това е списъкът на Страшния съд. Срещне ли дума от тук след разделител - реже всичко след нея.
+STOP_WORDS = [
+    # --- СГРАДЕН ФОНД & ЛОКАЦИЯ ---
+    r'ет\.', r'етаж', r'ет\s', r'е\.', r'ниво', r'Е-', # Е-1 style
+    r'ап\.', r'апартамент', r'ап\s', r'ап\d', r'ателие', r'ат\.', r'АП\.',
+    r'каб\.', r'кабинет', r'к-т', r'к\.\s*\d', r'к\d+', r'К-', # К-1 style
+    r'амб\.', r'амбулатория', r'амб\s',
+    r'стая', r'ст\.', r'ст\d',
+    r'офис', r'оф\.', 
+    r'помещение', r'зала', r'хале', r'салон', r'склад', 'мазе',
+    r'маг\.', r'магазин', r'обект', 
+    r'пав\.', r'павилион', r'барака', r'бунгало', 'фургон', 'контейнер', 'каравана',
+    r'партер', r'сутерен', r'приземен', r'кота', 'полуетаж', 'подблоково',
+    r'вх\.', r'вход', r'вх\s', r'В-', # В-А style
+    r'крило', r'сектор', r'тяло', r'корпус', r'база', r'Б:', # База: ...
+    r'блок\s+[А-Яа-я]', r'бл\.', r'бл\s', r'б\.', # Block variants
+    r'щанд', r'гараж', r'трафопост',
+
+    # --- МЕДИЦИНСКИ ИНСТИТУЦИИ (Hell Level abbreviations) ---
+    r'ДКЦ', r'МБАЛ', r'УМБАЛ', r'СБАЛ', r'МЦ\s', r'МЦ-', r'МДЦ', r'АИПП', r'СМДЛ', 'МСЦ', 'ДМСГД',
+    r'Поликлиника', r'п-ка', r'Здравна служба', r'Здравен дом', r'Здравен участък', r'Здраве',
+    r'СЗС', r'СЗУ', r'ФЗП', r'ФСМП', r'ЦСМП', 'АПЗЗ', 'СБР', 'ДП', 'ОБ', 'РБ', 'ВМБ',
+    r'Болница', r'Диспансер', r'Лаборатория', 'Микробиология', 'Рентген', 'Хематология', 'Хистология',
+    r'Филиал', r'Ф\.', r'Ф:', # Филиал:
+    r'ЦПЗ', r'КОЦ', r'ФДМ', r'ДЦ', r'ТЕЛК', r'РЗИ', r'ХЕИ', r'ОСП', 'ТДКЦ', 'ОДПФЗС',
+    r'ВМА', 'МБАБ', 'СБАЛО', 'СБАЛАГ', 'ОДПФЗС', 'УПМБАЛ', 'СБДПЛР', 'ЦКВБ', 'ЦКВЗ',
+    r'Медицински център', r'Дентален център', r'Болнична', r'Спешна помощ',
+    r'манипулационна', r'манип\.', r'приемно', r'регистратура', r'център за', r'звено',
+    r'отделение', r'клиника', r'катедра', r'\bЗС\b', 
+    r'СХБАЛ', 'СБАЛББ', 'МДЛ', 'СМЛ', 'ЛЗУ', 'ДДМУИ', 'ПФДПО', 'ОДОЗС',
+    r'РСП', 'ДПО', 'МТЛ', 'ЦНИКА', 'СБХЛ', 'ОМЦ', 'САГБАЛ', 'УСБАЛЕ', 'ГПСМП', 'АМЦСМП', 'ГППМП', 'АИСМП', 'ИПСМП', 'КЦА',
+    r'ЛК', r'РК', # Лекарски кабинет, Рентгенов кабинет
+
+    # --- ОБРАЗОВАНИЕ, АДМИНИСТРАЦИЯ И БИЗНЕС ---
+    r'кметство', r'община\s', r'съвет', r'читалище', r'поща', r'съдебна палата',
+    r'училище', r'ОУ\s', r'СУ\s', r'ЕГ\s', r'ПГ\s', r'СОУ\s', r'СПТУ', 'ПТУ', 'НУ\s', 'ДГ',
+    r'гимназия', 'колеж', 'университет', 'факултет', 'институт', 'академия', 'ПФК', 'НСА', 'БАН',
+    r'детска градина', r'ОДЗ', r'ясла', r'дом за', r'пансион', r'общежитие',
+    r'стадион', r'автогара', r'жп гара', r'гара', r'летище', 'терминал',
+    r'завод', 'цех', 'фабрика', 'предприятие', 'комбинат', 'миби', 'рудник',
+    r'АД\s', r'ЕООД', r'ООД', r'ЕАД', r'ЕТ\s', 'КД', 'СД', # Фирми
+    r'ООС', r'ДСК', 'МВР', 'БДЖ', 'ВиК', 'БТК', 'ТПК', 'ДЗИ', 'ДАП', 'АПК', 'ТКЗС', 'ПК',
+    r'Търговски център', r'ТЦ\s', r'Т\.Ц\.', r'Мол\s', r'Mall', r'Бизнес център', r'БЦ\s',
+    r'Ритейл', r'Аптека', r'Оптика', r'Дрогерия', r'супермаркет',
+    r'ТЕЦ', r'ВЕЦ', r'АЕЦ', r'Електроцентрала', r'ЗПЗ', r'СПЗ', r'НПЗ', r'ЮПЗ', r'ПЗ\s',
+
+    # --- ТУРИЗЪМ ---
+    r'хотел', r'х-л', r'комплекс', r'резорт', r'resort', 'вила', 'вили',
+    r'ваканционно', r'къмпинг', r'хижа', r'санаториум', r'балнео', 'СПА', 'SPA',
+    r'к\.к\.', r'к\.к', r'курортен комплекс', 'ваканционен',
+    r'ж\.г\.', r'жилищна група', r'в\.з\.', r'вилна зона', 
+    r'местност', r'м-ст',
+    r'стопански двор', r'к-с',
+
+    # --- CONNECTORS & BRAINROT ---
+    r'в сградата', r'сграда', r'бивш', r'бивша', r'бивше', 'бившо', 'старата',
+    r'срещу', r'до бл\.', r'до вх\.', r'зад ', r'на територията', 
+    r'продължение', r'разширение', r'до ', r'между', r'под ', r'на ъгъла', r'на гърба',
+    r'УПИ', r'ПИ\s', r'идентификатор', r'АОС', 'имот', 'кв\.', 'квартал \d', 'парцел', 'П-Л',
+    r'адрес 2', r'2-ри', r'3-ти', r'р-н',
+    r'Р\.П\.', r'УЧ-ЩЕ'
+]
+
+# Символи, които просто изчезват (кавички от всякакъв вид)
+_NUMERO_TO_SPACE = str.maketrans({'№': ' '})
+_DROP_QUOTES = str.maketrans('', '', '"„“\'`')
+
+def _stop_word_atoms(word):
+    """Splits a stop word into one-char atoms (escapes like \\. stay whole), or None if it uses real regex syntax."""
+    atoms = []
+    i = 0
+    while i < len(word):
+        if word[i] == '\\':
+            atoms.append(word[i:i + 2])
+            i += 2
+        elif word[i] in '.^$*+?{}[]()|':
+            return None
+        else:
+            atoms.append(re.escape(word[i].lower()))
+            i += 1
+    return atoms
+
+def _trie_alternation(node):
+    if None in node:
+        return ''
+    branches = [atom + _trie_alternation(child) for atom, child in sorted(node.items())]
+    return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+def build_stop_word_alternation(stop_words):
+    """Folds the kill list into a prefix trie so the regex engine checks ~40 branches per separator instead of ~250.
+    The stop word is followed by '.*$', so only *whether* some word matches matters - a word that extends
+    another one adds nothing and gets pruned."""
+    trie = {}
+    complex_words = []
+    for word in stop_words:
+        atoms = _stop_word_atoms(word)
+        if atoms is None:
+            complex_words.append(word)
+            continue
+        node = trie
+        for atom in atoms:
+            if None in node:
+                break
+            node = node.setdefault(atom, {})
+        else:
+            node.clear()
+            node[None] = {}
+    branches = ([_trie_alternation(trie)] if trie else []) + list(dict.fromkeys(complex_words))
+    return '|'.join(branches)
+
+class AddressNormalizer:
+    """The V16 cleaner compiled once at import. clean() is byte-for-byte what the old per-call version produced."""
+
+    def __init__(self, stop_words=STOP_WORDS, brainrot_indicators=BRAINROT_INDICATORS):
+        self.brainrot_indicators = tuple(brainrot_indicators)
+        self.ws_re = re.compile(r'\s+')
+        self.admin_guard_re = re.compile(r'обл|общ', re.IGNORECASE)
+        # Махаме "Обл.", "община" - те само бъркат Google Maps. Order matters, so they stay separate passes.
+        self.admin_res = [
+            re.compile(r'Обл\.\s*[^,;]+[,;]?', re.IGNORECASE),
+            re.compile(r'област\s*[^,;]+[,;]?', re.IGNORECASE),
+            re.compile(r'Общ\.\s*[^,;]+[,;]?', re.IGNORECASE),
+            re.compile(r'община\s*[^,;]+[,;]?', re.IGNORECASE),
+        ]
+        self.leading_number_re = re.compile(r'^\s*\d+[\.,]\s*')
+        # Regex Magic: (разделител) + (стоп дума) + (всичко до края)
+        self.stop_word_re = re.compile(r'[,\s\(\.\/-]+(?:' + build_stop_word_alternation(stop_words) + r').*$', re.IGNORECASE)
+        self.parens_re = re.compile(r'\(.*?\)')
+        self.slashes_re = re.compile(r'/.*?/')
+        self.nomer_re = re.compile(r'\bномер\b', re.IGNORECASE)
+        self.dangling_village_re = re.compile(r'\bс\.\s*$')
+        self.dangling_street_re = re.compile(r'\bул\.\s*$')
+        self.commas_re = re.compile(r',+')
+        self.city_re = re.compile(r'(гр\.|с\.)\s*([А-Яа-я\s\-]+)')
+        # Anything cached under a different kill list / version is stale
+        self.fingerprint = hashlib.sha1("\n".join(
+            [CLEANER_VERSION, *self.brainrot_indicators, self.stop_word_re.pattern]
+        ).encode('utf-8')).hexdigest()
+
+    def clean(self, raw_addr):
+        if not isinstance(raw_addr, str) or not raw_addr:
+            return ""
+
+        # 0. INSTANT KILL - ако целият стринг е само "Здравна служба" или подобно, нямаме адрес.
+        if len(raw_addr) < 25:
+            upper = raw_addr.upper()
+            if any(x in upper for x in self.brainrot_indicators):
+                return "INVALID_ADDRESS_METADATA"
+
+        # 1. STANDARDIZE SYMBOLS (Sigma Cleanup) - №, "номер", кавички
+        clean = raw_addr.translate(_NUMERO_TO_SPACE)
+        clean = clean.replace(' N ', ' ').replace(' No ', ' ').replace('номер', ' ').translate(_DROP_QUOTES)
+        clean = self.ws_re.sub(' ', clean)
+
+        # 2. REMOVE ADMINISTRATIVE PREFIXES - all four need "обл"/"общ" somewhere, so one scan usually skips them
+        if self.admin_guard_re.search(clean):
+            for admin_re in self.admin_res:
+                clean = admin_re.sub('', clean)
+
+        # Remove leading numbering (e.g. "1. София...")
+        clean = self.leading_number_re.sub('', clean)
+
+        # 3. THE KILL LIST
+        clean = self.stop_word_re.sub('', clean)
+
+        # Additional cleanup for things inside parentheses if they survived
+        if '(' in clean:
+            clean = self.parens_re.sub('', clean)
+        if '/' in clean:
+            clean = self.slashes_re.sub('', clean)
+
+        # 4. Specific Brainrot Fixes
+        clean = self.nomer_re.sub('', clean)
+        if clean.rstrip().endswith('.'):
+            clean = self.dangling_village_re.sub('', clean) # Ако завършва на "с." без име
+            clean = self.dangling_street_re.sub('', clean)  # Ако завършва на "ул." без име
+
+        # 5. Final Polish - двойни интервали, интервал преди запетая, двойни запетаи
+        clean = self.ws_re.sub(' ', clean).replace(' ,', ',')
+        if ',,' in clean:
+            clean = self.commas_re.sub(',', clean)
+
+        # Махаме точки, запетаи и тирета от края и началото
+        clean = clean.strip(' ,.-/\\')
+
+        # 6. Sanity Check (Da ne se izlojim pred chujdencite)
+        # Ако сме изтрили всичко (напр. адресът е бил само "АПЗЗ"), връщаме оригиналния или грешка
+        if len(clean) < 3:
+            # Try to extract just the city/village name as a last resort
+            if "гр." in raw_addr or "с." in raw_addr:
+                city_match = self.city_re.search(raw_addr)
+                if city_match:
+                    return city_match.group(0)
+            return "INVALID_ADDRESS_TOO_SHORT"
+
+        return clean
+
+    def clean_many(self, addresses):
+        """Batch API: list in -> list out, pd.Series in -> Series out (same index). Each distinct value is cleaned once."""
+        if isinstance(addresses, pd.Series):
+            codes, uniques = pd.factorize(addresses)
+            # Missing values get code -1, which lands on the trailing "" (same as clean(None))
+            cleaned = np.asarray([self.clean(u) for u in uniques] + [""], dtype=object)
+            return pd.Series(cleaned[codes], index=addresses.index, name=addresses.name, dtype=object)
+        seen = {}
+        out = []
+        for raw_addr in addresses:
+            try:
+                out.append(seen[raw_addr])
+            except KeyError:
+                seen[raw_addr] = result = self.clean(raw_addr)
+                out.append(result)
+        return out
+
+ADDRESS_NORMALIZER = AddressNormalizer()
+
 def clean_bg_address(raw_addr):
-    if not isinstance(raw_addr, str) or not raw_addr:
-        return ""
-    
-    # 0. INSTANT KILL (Metadata brainrot)
-    # Ако адресът съдържа тези думи и е твърде къс, значи е просто статус, а не локация.
-    brainrot_indicators = ["ЗАЛИЧЕН", "ЗАКРИТ", "НЕ СЪЩЕСТВУВА", "НЯМА ДАННИ", "ПРИЗЕМЕН", "СУТЕРЕН", "ПОЛИКЛИНИКА", "ЗДРАВНА СЛУЖБА", "СЗС"]
-    # Ако целият стринг е само "Здравна служба" или подобно, нямаме адрес.
-    if len(raw_addr) < 25 and any(x in raw_addr.upper() for x in brainrot_indicators):
-        return "INVALID_ADDRESS_METADATA"
-
-    # 1. STANDARDIZE SYMBOLS (Sigma Cleanup)
-    # Махаме №, думи като "номер", кавички и всякакви странни скоби
-    clean = raw_addr.replace('№', ' ').replace(' N ', ' ').replace(' No ', ' ').replace('номер', ' ')
-    clean = clean.replace('"', '').replace('„', '').replace('“', '').replace("'", "").replace("`", "")
-    
-    # Оправяне на римски цифри и интервали (напр. "VI - ТИ" -> "6", "ет. 2" -> "ет.2")
-    clean = re.sub(r'\s+', ' ', clean)
-    
-    # 2. REMOVE ADMINISTRATIVE PREFIXES (Admin junk)
-    # Махаме "Обл.", "община" - те само бъркат Google Maps.
-    clean = re.sub(r'Обл\.\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
-    clean = re.sub(r'област\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
-    clean = re.sub(r'Общ\.\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
-    clean = re.sub(r'община\s*[^,;]+[,;]?', '', clean, flags=re.IGNORECASE)
-    
-    # Remove leading numbering (e.g. "1. София...")
-    clean = re.sub(r'^\s*\d+[\.,]\s*', '', clean)
-
-    # 3. THE KILL LIST V16 (Updated with industrial, short-form horrors, and enrichments)
-    # Това е списъкът на Страшния съд. Срещне ли дума от тук след разделител - реже всичко след нея.
-    stop_words = [
-        # --- СГРАДЕН ФОНД & ЛОКАЦИЯ ---
-        r'ет\.', r'етаж', r'ет\s', r'е\.', r'ниво', r'Е-', # Е-1 style
-        r'ап\.', r'апартамент', r'ап\s', r'ап\d', r'ателие', r'ат\.', r'АП\.',
-        r'каб\.', r'кабинет', r'к-т', r'к\.\s*\d', r'к\d+', r'К-', # К-1 style
-        r'амб\.', r'амбулатория', r'амб\s',
-        r'стая', r'ст\.', r'ст\d',
-        r'офис', r'оф\.', 
-        r'помещение', r'зала', r'хале', r'салон', r'склад', 'мазе',
-        r'маг\.', r'магазин', r'обект', 
-        r'пав\.', r'павилион', r'барака', r'бунгало', 'фургон', 'контейнер', 'каравана',
-        r'партер', r'сутерен', r'приземен', r'кота', 'полуетаж', 'подблоково',
-        r'вх\.', r'вход', r'вх\s', r'В-', # В-А style
-        r'крило', r'сектор', r'тяло', r'корпус', r'база', r'Б:', # База: ...
-        r'блок\s+[А-Яа-я]', r'бл\.', r'бл\s', r'б\.', # Block variants
-        r'щанд', r'гараж', r'трафопост',
-        
-        # --- МЕДИЦИНСКИ ИНСТИТУЦИИ (Hell Level abbreviations) ---
-        r'ДКЦ', r'МБАЛ', r'УМБАЛ', r'СБАЛ', r'МЦ\s', r'МЦ-', r'МДЦ', r'АИПП', r'СМДЛ', 'МСЦ', 'ДМСГД',
-        r'Поликлиника', r'п-ка', r'Здравна служба', r'Здравен дом', r'Здравен участък', r'Здраве',
-        r'СЗС', r'СЗУ', r'ФЗП', r'ФСМП', r'ЦСМП', 'АПЗЗ', 'СБР', 'ДП', 'ОБ', 'РБ', 'ВМБ',
-        r'Болница', r'Диспансер', r'Лаборатория', 'Микробиология', 'Рентген', 'Хематология', 'Хистология',
-        r'Филиал', r'Ф\.', r'Ф:', # Филиал:
-        r'ЦПЗ', r'КОЦ', r'ФДМ', r'ДЦ', r'ТЕЛК', r'РЗИ', r'ХЕИ', r'ОСП', 'ТДКЦ', 'ОДПФЗС',
-        r'ВМА', 'МБАБ', 'СБАЛО', 'СБАЛАГ', 'ОДПФЗС', 'УПМБАЛ', 'СБДПЛР', 'ЦКВБ', 'ЦКВЗ',
-        r'Медицински център', r'Дентален център', r'Болнична', r'Спешна помощ',
-        r'манипулационна', r'манип\.', r'приемно', r'регистратура', r'център за', r'звено',
-        r'отделение', r'клиника', r'катедра', r'\bЗС\b', 
-        r'СХБАЛ', 'СБАЛББ', 'МДЛ', 'СМЛ', 'ЛЗУ', 'ДДМУИ', 'ПФДПО', 'ОДОЗС',
-        r'РСП', 'ДПО', 'МТЛ', 'ЦНИКА', 'СБХЛ', 'ОМЦ', 'САГБАЛ', 'УСБАЛЕ', 'ГПСМП', 'АМЦСМП', 'ГППМП', 'АИСМП', 'ИПСМП', 'КЦА',
-        r'ЛК', r'РК', # Лекарски кабинет, Рентгенов кабинет
-        
-        # --- ОБРАЗОВАНИЕ, АДМИНИСТРАЦИЯ И БИЗНЕС ---
-        r'кметство', r'община\s', r'съвет', r'читалище', r'поща', r'съдебна палата',
-        r'училище', r'ОУ\s', r'СУ\s', r'ЕГ\s', r'ПГ\s', r'СОУ\s', r'СПТУ', 'ПТУ', 'НУ\s', 'ДГ',
-        r'гимназия', 'колеж', 'университет', 'факултет', 'институт', 'академия', 'ПФК', 'НСА', 'БАН',
-        r'детска градина', r'ОДЗ', r'ясла', r'дом за', r'пансион', r'общежитие',
-        r'стадион', r'автогара', r'жп гара', r'гара', r'летище', 'терминал',
-        r'завод', 'цех', 'фабрика', 'предприятие', 'комбинат', 'миби', 'рудник',
-        r'АД\s', r'ЕООД', r'ООД', r'ЕАД', r'ЕТ\s', 'КД', 'СД', # Фирми
-        r'ООС', r'ДСК', 'МВР', 'БДЖ', 'ВиК', 'БТК', 'ТПК', 'ДЗИ', 'ДАП', 'АПК', 'ТКЗС', 'ПК',
-        r'Търговски център', r'ТЦ\s', r'Т\.Ц\.', r'Мол\s', r'Mall', r'Бизнес център', r'БЦ\s',
-        r'Ритейл', r'Аптека', r'Оптика', r'Дрогерия', r'супермаркет',
-        r'ТЕЦ', r'ВЕЦ', r'АЕЦ', r'Електроцентрала', r'ЗПЗ', r'СПЗ', r'НПЗ', r'ЮПЗ', r'ПЗ\s',
-        
-        # --- ТУРИЗЪМ ---
-        r'хотел', r'х-л', r'комплекс', r'резорт', r'resort', 'вила', 'вили',
-        r'ваканционно', r'къмпинг', r'хижа', r'санаториум', r'балнео', 'СПА', 'SPA',
-        r'к\.к\.', r'к\.к', r'курортен комплекс', 'ваканционен',
-        r'ж\.г\.', r'жилищна група', r'в\.з\.', r'вилна зона', 
-        r'местност', r'м-ст',
-        r'стопански двор', r'к-с',
-        
-        # --- CONNECTORS & BRAINROT ---
-        r'в сградата', r'сграда', r'бивш', r'бивша', r'бивше', 'бившо', 'старата',
-        r'срещу', r'до бл\.', r'до вх\.', r'зад ', r'на територията', 
-        r'продължение', r'разширение', r'до ', r'между', r'под ', r'на ъгъла', r'на гърба',
-        r'УПИ', r'ПИ\s', r'идентификатор', r'АОС', 'имот', 'кв\.', 'квартал \d', 'парцел', 'П-Л',
-        r'адрес 2', r'2-ри', r'3-ти', r'р-н',
-        r'Р\.П\.', r'УЧ-ЩЕ'
-    ]
-    
-    # Regex Magic: (разделител) + (стоп дума) + (всичко до края)
-    pattern_str = r'([,\s\(\.\/-]+)(' + '|'.join(stop_words) + r').*$'
-    
-    # 1. Clean using Stop Words
-    clean = re.sub(pattern_str, '', clean, flags=re.IGNORECASE)
+    return ADDRESS_NORMALIZER.clean(raw_addr)
 
-    # 2. Additional cleanup for things inside parentheses if they survived
-    clean = re.sub(r'\(.*?\)', '', clean)
-    clean = re.sub(r'/.*?/', '', clean)   
-    
-    # 3. Specific Brainrot Fixes
-    clean = re.sub(r'\bномер\b', '', clean, flags=re.IGNORECASE)
-    clean = re.sub(r'\bс\.\s*$', '', clean) # Ако завършва на "с." без име
-    clean = re.sub(r'\bул\.\s*$', '', clean) # Ако завършва на "ул." без име
-    
-    # 4. Final Polish
-    clean = re.sub(r'\s+', ' ', clean)      # Двойни интервали -> единичен
-    clean = re.sub(r'\s,', ',', clean)      # Интервал преди запетая
-    clean = re.sub(r',+', ',', clean)       # Двойни запетаи
-    
-    # Махаме точки, запетаи и тирета от края и началото
-    clean = clean.strip(' ,.-/\\')
-    
-    # 5. Sanity Check (Da ne se izlojim pred chujdencite)
-    # Ако сме изтрили всичко (напр. адресът е бил само "АПЗЗ"), връщаме оригиналния или грешка
-    if len(clean) < 3:
-        # Check if original had city info
-        if "гр." in raw_addr or "с." in raw_addr:
-             # Try to extract just the city/village name as a last resort
-             city_match = re.search(r'(гр\.|с\.)\s*([А-Яа-я\s\-]+)', raw_addr)
-             if city_match:
-                 return city_match.group(0)
-        return "INVALID_ADDRESS_TOO_SHORT"
-
-    return clean
-
-def get_processed_ids():
+def _fmt_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(max(seconds, 0))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+class Metrics:
+    """Latency samples per stage (p50/p95/p99), counters and a rolling IDs/min rate. Safe to call from fetch workers."""
+
+    STAGE_FIELDS = ['count', 'total_s', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+    def __init__(self, window=RATE_WINDOW_SECONDS, progress_every=PROGRESS_EVERY_SECONDS):
+        self.samples = {} # stage -> array of seconds (8 bytes a sample, a 6h run is a few MB at most)
+        self.counters = Counter()
+        self.window = window
+        self.progress_every = progress_every
+        self.finished = deque() # monotonic timestamps of recently finished IDs
+        self.started = time.monotonic()
+        self.last_progress = self.started
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = array('d')
+            samples.append(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - t0)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def id_finished(self, outcome):
+        """One ID settled (done / failed / queued for retry) - feeds the counters and the rolling rate."""
+        now = time.monotonic()
+        with self.lock:
+            self.counters[f"ids_{outcome}"] += 1
+            self.finished.append(now)
+            self._trim(now)
+
+    def _trim(self, now):
+        while self.finished and now - self.finished[0] > self.window:
+            self.finished.popleft()
+
+    def ids_per_minute(self):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            span = min(self.window, now - self.started)
+            return len(self.finished) / span * 60 if span > 0 else 0.0
+
+    def eta_seconds(self, remaining):
+        rate = self.ids_per_minute()
+        return remaining / rate * 60 if rate else None
+
+    def recent_percentile(self, stage, q, last=1000):
+        """Percentile (seconds) over the latest samples only - cheap enough to ask every few seconds."""
+        with self.lock:
+            samples = sorted(self.samples.get(stage, array('d'))[-last:])
+        return samples[min(len(samples) - 1, int(q * len(samples)))] if samples else 0.0
+
+    def summary(self, stage):
+        samples = sorted(self.samples.get(stage, ()))
+        if not samples:
+            return dict.fromkeys(self.STAGE_FIELDS, 0)
+        pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+        total = sum(samples)
+        return {'count': len(samples), 'total_s': round(total, 3), 'mean_ms': round(total / len(samples) * 1000, 2),
+                'p50_ms': round(pick(0.50), 2), 'p95_ms': round(pick(0.95), 2), 'p99_ms': round(pick(0.99), 2),
+                'max_ms': round(samples[-1] * 1000, 2)}
+
+    def progress(self, done, total, limiter=None, label="", force=False):
+        """Prints one status line, at most every progress_every seconds, instead of a line per ID."""
+        now = time.monotonic()
+        if not force and now - self.last_progress < self.progress_every:
+            return
+        self.last_progress = now
+        c = self.counters
+        eta = self.eta_seconds(total - done)
+        budget_left = MAX_RUNTIME_SECONDS - (time.time() - START_TIME)
+        verdict = " (won't fit, next run takes the rest)" if eta is not None and eta > budget_left else ""
+        rate = f" @ {limiter.rate:.2f} req/s" if limiter else ""
+        print(f"{label}[{done}/{total}] {done / total * 100 if total else 100:.1f}% | {self.ids_per_minute():.1f} IDs/min{rate} | "
+              f"ok {c['ids_done']} fail {c['ids_failed']} retry {c['ids_retry']} | "
+              f"ETA {_fmt_duration(eta)}, budget left {_fmt_duration(budget_left)}{verdict}", flush=True)
+
+    def report(self, path=PERF_REPORT_FILE, **run_info):
+        """Writes the JSON report (run info + stages + counters) and a CSV of the stage table next to it."""
+        stages = {stage: self.summary(stage) for stage in sorted(self.samples)}
+        elapsed = time.monotonic() - self.started
+        rss = _peak_rss_mb()
+        settled = sum(v for k, v in self.counters.items() if k.startswith('ids_'))
+        report = dict(run=TIMESTAMP, **run_info, elapsed_s=round(elapsed, 1), budget_s=MAX_RUNTIME_SECONDS,
+                      ids_per_minute=round(settled / elapsed * 60, 1) if elapsed else 0.0,
+                      ids_per_minute_recent=round(self.ids_per_minute(), 1), peak_rss_mb=round(rss, 1) if rss == rss else None,
+                      stages=stages, counters=dict(sorted(self.counters.items())))
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            with open(os.path.splitext(path)[0] + '.csv', 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['stage'] + self.STAGE_FIELDS)
+                for stage, summary in stages.items():
+                    writer.writerow([stage] + [summary[k] for k in self.STAGE_FIELDS])
+        except OSError as e:
+            print(f"Perf report could not be written ({e}). Not fatal.")
+            return None
+        line = ", ".join(f"{stage} p50 {s['p50_ms']:.1f}ms p95 {s['p95_ms']:.1f}ms" for stage, s in stages.items())
+        print(f"Perf: {report['ids_per_minute']} IDs/min over {_fmt_duration(elapsed)}; {line}")
+        print(f"Perf report: {path}")
+        return report
+
+METRICS = Metrics()
+
+class TimeBudget:
+    """Decides when to stop taking new IDs so the drain, the last checkpoint and the final save still finish
+    inside MAX_RUNTIME_SECONDS. Costs are learned while running: in-flight drain time from the recent fetch
+    latencies, seconds per ID from the rolling rate, save seconds per unit (part-file MB / delta row) from a probe.
+    SIGTERM/SIGINT just flip it to "stop" - a second Ctrl+C kills for real."""
+
+    def __init__(self, save_seconds_per_unit=SAVE_SECONDS_PER_MB, budget=MAX_RUNTIME_SECONDS, started=START_TIME,
+                 safety=FINISH_SAFETY_SECONDS, recheck_every=5):
+        self.deadline = started + budget
+        self.save_seconds_per_unit = save_seconds_per_unit
+        self.save_probed = False
+        self.safety = safety
+        self.recheck_every = recheck_every
+        self.drain_seconds = REQUEST_TIMEOUT # Until we have latencies
+        self.last_recheck = 0.0
+        self.stop_reason = None
+        self.interrupted = threading.Event()
+
+    def install_signal_handlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        if self.interrupted.is_set():
+            raise KeyboardInterrupt # Second one - the user really means it
+        self.interrupted.set()
+        self.stop_reason = signal.Signals(signum).name
+        print(f"\n!!! {self.stop_reason} received: no new IDs, draining in-flight ones and saving. Again to kill hard.", flush=True)
+
+    def learn_save(self, seconds, units):
+        if units > 0:
+            self.save_seconds_per_unit = seconds / units
+            self.save_probed = True
+
+    def save_estimate(self, units):
+        return 1.0 + units * self.save_seconds_per_unit * 1.25 # Workbook overhead + 25% for the unknown
+
+    def _refresh_drain(self):
+        now = time.monotonic()
+        if now - self.last_recheck >= self.recheck_every:
+            self.last_recheck = now
+            # In-flight requests run in parallel, so the drain is about one slow request (+ its wait for a token)
+            self.drain_seconds = max(METRICS.recent_percentile('fetch', 0.99) + METRICS.recent_percentile('rate_wait', 0.99), 1.0)
+
+    def seconds_per_id(self):
+        rate = METRICS.ids_per_minute()
+        return 60 / rate if rate else 0.0
+
+    def work_seconds_left(self, save_units):
+        """Wall time still usable for fetching once the drain, the final save and the safety slack are set aside."""
+        self._refresh_drain()
+        return self.deadline - time.time() - self.drain_seconds - self.save_estimate(save_units) - self.safety
+
+    def should_stop(self, save_units):
+        if self.interrupted.is_set():
+            return True
+        # The next ID has to fit too
+        if self.work_seconds_left(save_units) <= self.seconds_per_id():
+            self.stop_reason = self.stop_reason or "time budget"
+            return True
+        return False
+
+    def wait(self, seconds):
+        """Sleeps, but wakes up right away on SIGTERM/SIGINT."""
+        self.interrupted.wait(seconds)
+
+class AddressCache:
+    """Bounded LRU memo for clean_bg_address keyed by the raw address, with an optional SQLite layer underneath."""
+
+    def __init__(self, normalizer=ADDRESS_NORMALIZER, maxsize=ADDRESS_CACHE_SIZE):
+        self.normalizer = normalizer
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        self.pending_writes = []
+
+    def open_disk(self, path=ADDRESS_CACHE_FILE):
+        """Attaches the persistent layer. Entries from another cleaner version get wiped."""
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS addresses (raw TEXT PRIMARY KEY, clean TEXT NOT NULL)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if not row or row[0] != self.normalizer.fingerprint:
+            self.db.execute("DELETE FROM addresses")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)", (self.normalizer.fingerprint,))
+        self.db.commit()
+
+    def get(self, raw_addr):
+        if not isinstance(raw_addr, str) or not raw_addr:
+            return self.normalizer.clean(raw_addr)
+        try:
+            value = self.entries[raw_addr]
+            self.entries.move_to_end(raw_addr)
+            self.hits += 1
+            return value
+        except KeyError:
+            pass
+
+        row = self.db.execute("SELECT clean FROM addresses WHERE raw = ?", (raw_addr,)).fetchone() if self.db else None
+        if row:
+            value = row[0]
+            self.disk_hits += 1
+        else:
+            t0 = time.perf_counter()
+            value = self.normalizer.clean(raw_addr)
+            METRICS.observe('clean_address', time.perf_counter() - t0)
+            self.misses += 1
+            if self.db:
+                self.pending_writes.append((raw_addr, value))
+                if len(self.pending_writes) >= 500:
+                    self.flush()
+
+        self.entries[raw_addr] = value
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return value
+
+    def flush(self):
+        if self.db and self.pending_writes:
+            self.db.executemany("INSERT OR REPLACE INTO addresses VALUES (?, ?)", self.pending_writes)
+            self.db.commit()
+        self.pending_writes = []
+
+    def close(self):
+        self.flush()
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        hit_rate = (self.hits + self.disk_hits) / lookups * 100 if lookups else 0.0
+        return (f"Address cache: {lookups} lookups, {self.hits} memory hits, {self.disk_hits} disk hits, "
+                f"{self.misses} misses ({hit_rate:.1f}% hit rate, {len(self.entries)}/{self.maxsize} in memory)")
+
+ADDRESS_CACHE = AddressCache()
+
+def _address_cache_counts():
+    return {'memory_hits': ADDRESS_CACHE.hits, 'disk_hits': ADDRESS_CACHE.disk_hits, 'misses': ADDRESS_CACHE.misses}
+
+class AddressIndex:
+    """Canonical Address_IDs for cleaned addresses. The key is the settlement (ekatte), district and municipality
+    plus the clean string folded for case, spacing, punctuation and the usual abbreviations, so
+    "гр. София, ул. Гладстон 5А" and "улица  Гладстон 5 а" under the same ekatte land on one ID. Memoized."""
+
+    # Long form -> short form, after punctuation is gone ("бул." and "булевард" both end up "бул")
+    ABBREVIATIONS = {
+        'улица': 'ул', 'булевард': 'бул', 'булевар': 'бул', 'площад': 'пл', 'квартал': 'кв',
+        'блок': 'бл', 'вход': 'вх', 'етаж': 'ет', 'апартамент': 'ап', 'кабинет': 'каб', 'град': 'гр', 'село': 'с',
+    }
+    # What the cleaner returns when there is nothing to geocode
+    NOT_AN_ADDRESS = {'', 'N/A', 'INVALID_ADDRESS_METADATA', 'INVALID_ADDRESS_TOO_SHORT'}
+    SETTLEMENT_MARKERS = {'гр', 'с'}
+    STREET_MARKERS = {'ул', 'бул', 'жк', 'кв', 'пл'}
+
+    def __init__(self, maxsize=ADDRESS_CACHE_SIZE):
+        self.jk_re = re.compile(r'\bж\.\s*к\b\.?|\bжилищен\s+комплекс\b')
+        self.word_re = re.compile(r'[^\s.,;:\-–—/\\"\'„“”«»()№#]+') # Punctuation is just another separator
+        self.canonical = functools.lru_cache(maxsize=maxsize)(self._canonical)
+
+    @staticmethod
+    def _merge_house_letters(tokens):
+        merged = []
+        for token in tokens:
+            if len(token) == 1 and 'а' <= token <= 'я' and merged and merged[-1][-1:].isdigit():
+                merged[-1] += token # "5 а" -> "5а"
+            else:
+                merged.append(token)
+        return merged
+
+    def _drop_settlement(self, tokens, head_len):
+        """Strips the "гр. София" of "гр. София, ул. X" / "гр. София ул. X" - the ekatte already pins the settlement, so the
+        prefix only splits duplicates. The name ends at the first comma (`head_len` tokens in) or street marker,
+        whichever comes first; with no street marker after it the prefix stays (the name may be all there is)."""
+        street_markers = self.STREET_MARKERS
+        for cut in range(2, head_len):
+            if tokens[cut] in street_markers:
+                return tokens[cut:]
+        street = tokens[head_len:]
+        return tokens if street_markers.isdisjoint(street) else street
+
+    def normalize(self, clean):
+        text = clean.casefold()
+        if 'ж' in text:
+            text = self.jk_re.sub(' жк ', text)
+        abbreviations = self.ABBREVIATIONS
+        tokens = [abbreviations.get(token, token) for token in self.word_re.findall(text)]
+        if len(tokens) > 2 and tokens[0] in self.SETTLEMENT_MARKERS:
+            comma = text.find(',')
+            head_len = len(self.word_re.findall(text, 0, comma)) if comma >= 0 else len(tokens)
+            tokens = self._drop_settlement(tokens, head_len)
+        if tokens and min(map(len, tokens)) == 1: # Only a lone letter can be a split house number
+            tokens = self._merge_house_letters(tokens)
+        return ' '.join(tokens)
+
+    def _canonical(self, clean, ekatte=None, district=None, municipality=None):
+        """-> (Address_ID, normalized text), or None for placeholders/invalid addresses."""
+        if not isinstance(clean, str) or clean in self.NOT_AN_ADDRESS:
+            return None
+        t0 = time.perf_counter()
+        normalized = self.normalize(clean)
+        if not normalized:
+            return None
+        key = "\x1f".join((ekatte or '', district or '', municipality or '', normalized))
+        address_id = ADDRESS_ID_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        METRICS.observe('address_index', time.perf_counter() - t0)
+        return address_id, normalized
+
+    def address_id(self, clean, ekatte=None, district=None, municipality=None):
+        found = self.canonical(clean, ekatte, district, municipality)
+        return found[0] if found else None
+
+    @staticmethod
+    def unique_rows(address_rows):
+        """Address rows (dicts with Address_ID) -> one Unique_Addresses row per ID, most frequent spelling first
+        (ties: shortest, then alphabetical - same pick as v_unique_addresses). A generator, so it only reads
+        its input once the workbook gets to this sheet."""
+        groups = {}
+        for row in address_rows:
+            address_id = row.get('Address_ID')
+            if not address_id:
+                continue
+            group = groups.get(address_id)
+            if group is None:
+                group = groups[address_id] = (row.get('City'), row.get('Region'), row.get('Municipality'), Counter())
+            group[3][row.get('Full_Address_Clean')] += 1
+        ordered = sorted(groups.items(), key=lambda item: (item[1][1] or '', item[1][2] or '', item[1][0] or '', item[0]))
+        for address_id, (city, region, municipality, spellings) in ordered:
+            best = min(spellings.items(), key=lambda kv: (-kv[1], len(kv[0]), kv[0]))[0]
+            yield {'Address_ID': address_id, 'City': city, 'Region': region, 'Municipality': municipality,
+                   'Full_Address_Clean': best, 'Occurrences': sum(spellings.values())}
+
+ADDRESS_INDEX = AddressIndex()
+
+def get_processed_ids(log_file=PROCESSED_LOG_FILE):
     """Reads the list of ID-chovtsi we already destroyed."""
-    if not os.path.exists(PROCESSED_LOG_FILE):
+    if not os.path.exists(log_file):
         return set()
-    with open(PROCESSED_LOG_FILE, 'r', encoding='utf-8') as f:
+    with open(log_file, 'r', encoding='utf-8') as f:
         # Reading lines like a Sigma reader
         return set(line.strip() for line in f if line.strip())
 
-def save_processed_id(id_val):
-    """Appends a completed ID to the log file immediately."""
-    with open(PROCESSED_LOG_FILE, 'a', encoding='utf-8') as f:
-        f.write(f"{id_val}\n")
+def get_failed_ids(log_file=FAILED_LOG_FILE):
+    """ID -> last failure reason."""
+    failed = {}
+    if os.path.exists(log_file):
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                id_val, _, reason = line.rstrip('\n').partition('\t')
+                if id_val.strip():
+                    failed[id_val.strip()] = reason
+    return failed
 
-def load_ids_from_col_b():
-    print(f"Yo shefe, targeting: {INPUT_FILE_PATH}")
-    if not os.path.exists(INPUT_FILE_PATH):
-        print("Faila go nyama. Slagay go pri skripta, lyolyo.")
-        sys.exit(1)
-    
-    # Reading excel... hope your RAM has enough rizz
-    temp_file = os.path.join(SCRIPT_DIR, "temp_brainrot_copy.xlsx")
+def _append_durably(path, lines):
+    with open(path, 'a', encoding='utf-8') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+class Shard:
+    """Which slice of the IDs this process owns, and where it keeps its own files."""
+
+    def __init__(self, index=SHARD_INDEX, count=SHARD_COUNT):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Shard index {index} does not fit shard count {count}")
+        self.index = index
+        self.count = count
+
+    def owns(self, id_val):
+        # crc32, not hash(): str hashing is salted per process, and every runner must agree
+        return self.count == 1 or zlib.crc32(id_val.encode('utf-8')) % self.count == self.index
+
+    def path(self, path):
+        """processed_ids.txt -> processed_ids.shard-2.txt (unchanged when not sharded)."""
+        if self.count == 1:
+            return path
+        root, ext = os.path.splitext(path)
+        return f"{root}.shard-{self.index}{ext}"
+
+    def __str__(self):
+        return f"shard {self.index + 1}/{self.count}"
+
+def shard_files(path):
+    """Every per-shard sibling of a shared file (processed_ids.txt -> processed_ids.shard-*.txt)."""
+    root, ext = os.path.splitext(path)
+    return sorted(glob.glob(f"{glob.escape(root)}.shard-*{ext}"))
+
+class RetryQueue:
+    """Transient failures waiting for another shot: ID -> attempts, last error, next attempt (epoch seconds)."""
+
+    def __init__(self, path=RETRY_QUEUE_FILE):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, id_val):
+        return id_val in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def schedule(self, id_val, reason, now=None):
+        """Books the next attempt with exponential backoff + jitter. False once the ID is out of attempts."""
+        now = time.time() if now is None else now
+        attempts = self.entries.get(id_val, {}).get('attempts', 0) + 1
+        if attempts >= RETRY_MAX_ATTEMPTS:
+            self.entries.pop(id_val, None)
+            return False
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempts - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        self.entries[id_val] = {'attempts': attempts, 'last_error': reason, 'next_attempt': now + delay}
+        return True
+
+    def discard(self, id_val):
+        self.entries.pop(id_val, None)
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return sorted((x for x, e in self.entries.items() if e['next_attempt'] <= now),
+                      key=lambda x: self.entries[x]['next_attempt'])
+
+    def seconds_until_next(self, now=None):
+        if not self.entries:
+            return None
+        now = time.time() if now is None else now
+        return max(0.0, min(e['next_attempt'] for e in self.entries.values()) - now)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+class Checkpoint:
+    """Progress log. An ID is only committed after the part file carrying its rows is on disk,
+    and the part file header doubles as the journal to replay if we die in between."""
+
+    def __init__(self, processed_file=PROCESSED_LOG_FILE, failed_file=FAILED_LOG_FILE, retry_file=RETRY_QUEUE_FILE,
+                 shard=None):
+        self.processed_file = processed_file
+        self.failed_file = failed_file
+        self.done = get_processed_ids(processed_file)
+        self.failed = get_failed_ids(failed_file)
+        self.retry = RetryQueue(retry_file)
+        if shard and shard.count > 1:
+            # The shared logs are read-only history for a shard; its own retries start as its slice of the shared queue
+            self.done |= get_processed_ids(PROCESSED_LOG_FILE)
+            for id_val, reason in get_failed_ids(FAILED_LOG_FILE).items():
+                self.failed.setdefault(id_val, reason)
+            if not os.path.exists(retry_file):
+                self.retry.entries = {k: v for k, v in RetryQueue(RETRY_QUEUE_FILE).entries.items() if shard.owns(k)}
+
+    def is_settled(self, id_val):
+        return id_val in self.done or id_val in self.failed
+
+    def commit(self, done_ids, failed, retries=None):
+        """One append + fsync per log for the whole chunk (no more per-ID open/close).
+        `retries` (ID -> reason) go back into the retry queue, or to the failed log once out of attempts."""
+        failed = dict(failed)
+        queue_changed = False
+        for id_val, reason in (retries or {}).items():
+            if id_val in self.done:
+                continue
+            queue_changed = True
+            if not self.retry.schedule(id_val, reason):
+                failed[id_val] = f"Gave up after {RETRY_MAX_ATTEMPTS} attempts: {reason}"
+        new_done = [x for x in done_ids if x not in self.done]
+        new_failed = {k: v for k, v in failed.items() if k not in self.failed and k not in self.done}
+        if new_done:
+            _append_durably(self.processed_file, [f"{x}\n" for x in new_done])
+            self.done.update(new_done)
+        if new_failed:
+            _append_durably(self.failed_file, [f"{k}\t{v}\n" for k, v in new_failed.items()])
+            self.failed.update(new_failed)
+        for id_val in list(new_done) + list(new_failed):
+            if id_val in self.retry:
+                self.retry.discard(id_val)
+                queue_changed = True
+        if queue_changed:
+            self.retry.save()
+
+    def recover(self, part_dirs):
+        """Replays part file headers: IDs whose rows hit the disk but never made it into the log."""
+        recovered = 0
+        for part_dir in part_dirs:
+            for path in sorted(glob.glob(os.path.join(part_dir, "part_*.jsonl"))):
+                with open(path, 'r', encoding='utf-8') as f:
+                    marker, header = json.loads(f.readline())
+                if marker != COMMIT_MARKER:
+                    continue
+                before = len(self.done) + len(self.failed)
+                # A retry already in the queue was committed before - replaying it would burn an attempt
+                retries = {k: v for k, v in header.get('retry', {}).items()
+                           if k not in self.retry and not self.is_settled(k)}
+                self.commit(header.get('done', []), header.get('failed', {}), retries)
+                recovered += len(self.done) + len(self.failed) - before
+        if recovered:
+            print(f"Checkpoint recovery: {recovered} ID-chovtsi were on disk but not in the log. Fixed.")
+        return recovered
+
+def _normalize_id(value):
+    """Cell value -> ID string, or None for blanks (same rules the old pandas dtype=str path had)."""
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    s_val = str(value).strip()
+    if s_val.lower() == 'nan' or s_val == "":
+        return None
+    if s_val.endswith('.0'):
+        s_val = s_val[:-2]
+    return s_val
+
+def _file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _read_id_index(index_path, signature):
+    """Sidecar ID list: first line is the workbook hash it was built from (mtime is useless after a git checkout)."""
     try:
-        shutil.copy2(INPUT_FILE_PATH, temp_file)
-        df = pd.read_excel(temp_file, dtype=str)
-        
-        if df.shape[1] < 2:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            if f.readline().rstrip('\n') != signature:
+                return None
+            return [line.rstrip('\n') for line in f]
+    except OSError:
+        return None
+
+def _write_id_index(index_path, signature, ids):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(signature + "\n")
+        f.writelines(f"{x}\n" for x in ids)
+    os.replace(tmp_path, index_path)
+
+def _stream_col_b(path):
+    """Streams only column B of the first sheet (header row skipped) - no DataFrame, no full parse."""
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[0]
+        header = next(ws.iter_rows(max_row=1, values_only=True), ())
+        if len(header) < 2:
             print("!!! GRESHKA: Tozi fail nyama Kolona B. Negative IQ moment.")
-            os.remove(temp_file)
             sys.exit(1)
+        ids = []
+        for (value,) in ws.iter_rows(min_row=2, min_col=2, max_col=2, values_only=True):
+            id_val = _normalize_id(value)
+            if id_val is not None:
+                ids.append(id_val)
+        return ids
+    finally:
+        wb.close()
 
-        print(">>> Grabbing IDs from COLUMN B...")
-        raw_list = df.iloc[:, 1].tolist()
-        
-        clean_list = []
-        for x in raw_list:
+def _peak_rss_mb():
+    if resource is None:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # bytes on macOS, KiB on Linux
+
+def load_ids_from_col_b(input_path=INPUT_FILE_PATH):
+    print(f"Yo shefe, targeting: {input_path}")
+    if not os.path.exists(input_path):
+        print("Faila go nyama. Slagay go pri skripta, lyolyo.")
+        sys.exit(1)
+
+    t0 = time.perf_counter()
+    index_path = input_path + ID_INDEX_SUFFIX
+    try:
+        signature = _file_sha1(input_path)
+        clean_list = _read_id_index(index_path, signature)
+        source = "ID index"
+        if clean_list is None:
+            print(">>> Grabbing IDs from COLUMN B...")
+            source = "workbook"
             try:
-                s_val = str(x).strip()
-                if s_val.lower() == 'nan' or s_val == "": continue
-                if s_val.endswith('.0'): s_val = s_val[:-2]
-                clean_list.append(s_val)
-            except: continue
-        
-        print(f"Loaded {len(clean_list)} total ID-chovtsi.")
-        del df 
-        try: os.remove(temp_file)
-        except: pass
-        return clean_list
+                clean_list = _stream_col_b(input_path)
+            except PermissionError:
+                # Excel on Windows locks the file - read a copy instead
+                temp_file = os.path.join(SCRIPT_DIR, "temp_brainrot_copy.xlsx")
+                shutil.copy2(input_path, temp_file)
+                try:
+                    clean_list = _stream_col_b(temp_file)
+                finally:
+                    try: os.remove(temp_file)
+                    except OSError: pass
+            try:
+                _write_id_index(index_path, signature, clean_list)
+            except OSError as e:
+                print(f"Could not write ID index ({e}), next start will parse the workbook again.")
     except Exception as e:
         print(f"Failed to read file: {e}")
         sys.exit(1)
 
-def fetch_details(id_number):
-    # API endpoint goes brrr
-    url = f'https://registries.his.bg/api/V1/outpatientcare/getOutpatientCareByNumberForApiV1?number={id_number}'
+    print(f"Loaded {len(clean_list)} total ID-chovtsi from {source} in {time.perf_counter() - t0:.2f}s "
+          f"(peak RSS {_peak_rss_mb():.1f} MB).")
+    return clean_list
+
+class AdaptiveRateLimiter:
+    """Token bucket shared by all fetch workers. AIMD: +RATE_STEP when healthy, x BACKOFF_FACTOR when throttled."""
+
+    def __init__(self, rate=RATE_START, min_rate=RATE_MIN, max_rate=RATE_MAX):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate = min(max(rate, min_rate), max_rate)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_cut = 0.0
+        self.healthy_streak = 0
+        self.throttle_count = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        # Capacity of one token keeps the spacing even - bursts are what trip the WAF
+        self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, stop=None):
+        """Blocks until the bucket lets one request through -> True. With a `stop` Event, setting it ends the
+        wait early (even a long server Retry-After) -> False, and no token is taken."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.blocked_until and self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return True
+                delay = max(self.blocked_until - now, (1.0 - self.tokens) / self.rate)
+            # A bit of jitter so we don't look like a metronome-chovek
+            delay += random.uniform(0, 0.1 / self.rate)
+            if stop is None:
+                time.sleep(delay)
+            elif stop.wait(delay):
+                return False
+
+    def on_success(self):
+        with self.lock:
+            self.healthy_streak += 1
+            if self.healthy_streak >= RAMP_EVERY:
+                self.healthy_streak = 0
+                self.rate = min(self.max_rate, self.rate + RATE_STEP)
+
+    def on_throttle(self, retry_after=None):
+        """403/429/5xx/timeout (any transient answer): cut the rate (once per cool-down window) and pause everyone."""
+        with self.lock:
+            now = time.monotonic()
+            self.healthy_streak = 0
+            self.throttle_count += 1
+            # All in-flight workers see the same 429 burst - only cut once for it
+            if now - self.last_cut >= 1.0 / self.rate:
+                self.rate = max(self.min_rate, self.rate * BACKOFF_FACTOR)
+                self.last_cut = now
+            pause = retry_after if retry_after else 1.0 / self.rate
+            self.blocked_until = max(self.blocked_until, now + pause)
+            self.tokens = min(self.tokens, 0.0)
+
+def _retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 404:
-            return None
-        else:
-            print(f"    [!] Error {response.status_code} for ID {id_number}.")
-            return None
-    except Exception as e:
-        print(f"    [!] Network died (Skill Issue) on {id_number}: {e}")
+        return float(value) if value else None
+    except ValueError:
         return None
 
+def make_session(pool_size=CONCURRENCY):
+    """One keep-alive session for all workers, pool sized to the worker count."""
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Failure kinds: a real 404 is final, a blip goes to the retry queue, anything else weird is final too
+NOT_FOUND = 'not_found'
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+def classify_failure(status_code=None, exc=None):
+    """Failure kind for an HTTP status or an exception raised while fetching/decoding."""
+    if exc is not None:
+        # Timeouts, dropped connections and HTML error pages instead of JSON are all worth another shot
+        return TRANSIENT if isinstance(exc, (requests.RequestException, ValueError)) else PERMANENT
+    if status_code == 404:
+        return NOT_FOUND
+    if status_code in (403, 408, 425, 429) or (status_code is not None and status_code >= 500):
+        return TRANSIENT # 403 is how the WAF says "go touch grass" - not a real permission problem
+    return PERMANENT
+
+def fetch_with_reason(id_number, session=None, limiter=None, stop=None):
+    """Returns (data, None) on success, (None, (kind, reason)) otherwise - see classify_failure.
+    Once the `stop` Event is set (SIGTERM/SIGINT) there are no more token waits or in-place retries."""
+    # API endpoint goes brrr
+    url = f'{API_URL}?number={id_number}'
+    http = session or requests
+    # With a limiter we own the throttling, so a 403/429/5xx/timeout gets retried after the back-off
+    attempts = 1 + (THROTTLE_RETRIES if limiter else 0)
+    for attempt in range(1, attempts + 1):
+        if limiter:
+            with METRICS.timer('rate_wait'):
+                acquired = limiter.acquire(stop)
+            if not acquired:
+                return None, (TRANSIENT, "Stopped before the request went out")
+        try:
+            with METRICS.timer('fetch'):
+                response = http.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+            METRICS.count(f"http_{response.status_code}")
+            # Whatever classify_failure calls transient is the server/WAF pushing back - never a reason to ramp up
+            if response.status_code not in (200, 404) and classify_failure(response.status_code) == TRANSIENT:
+                if limiter:
+                    limiter.on_throttle(_retry_after_seconds(response))
+                    if attempt < attempts and not (stop and stop.is_set()):
+                        METRICS.count('throttle_retries')
+                        continue
+            elif limiter:
+                limiter.on_success()
+
+            if response.status_code == 200:
+                data = response.json()
+                return (data, None) if data else (None, (NOT_FOUND, "HTTP 200 with empty body"))
+            elif response.status_code == 404:
+                return None, (NOT_FOUND, "HTTP 404")
+            else:
+                print(f"    [!] Error {response.status_code} for ID {id_number}.")
+                return None, (classify_failure(response.status_code), f"HTTP {response.status_code}")
+        except requests.RequestException as e:
+            METRICS.count(f"exc_{type(e).__name__}")
+            if limiter:
+                limiter.on_throttle()
+                if attempt < attempts and not (stop and stop.is_set()):
+                    METRICS.count('throttle_retries')
+                    continue
+            print(f"    [!] Network died (Skill Issue) on {id_number}: {e}")
+            return None, (classify_failure(exc=e), f"{type(e).__name__}: {e}")
+        except Exception as e:
+            print(f"    [!] Network died (Skill Issue) on {id_number}: {e}")
+            return None, (classify_failure(exc=e), f"{type(e).__name__}: {e}")
+
+def fetch_details(id_number, session=None, limiter=None):
+    return fetch_with_reason(id_number, session, limiter)[0]
+
+def fetch_many(ids, session, limiter, concurrency=CONCURRENCY, should_stop=None, stop=None):
+    """Yields (id, data, failure) as responses land, with at most `concurrency` requests in flight.
+    Once should_stop() says so, no new IDs are taken and the in-flight ones are drained. The `stop` Event
+    (TimeBudget.interrupted) also cuts the in-flight ones short - see fetch_with_reason."""
+    pending = iter(ids)
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        in_flight = {}
+
+        def top_up():
+            nonlocal exhausted
+            while not exhausted and len(in_flight) < concurrency:
+                if should_stop and should_stop():
+                    exhausted = True
+                    return
+                try:
+                    id_number = next(pending)
+                except StopIteration:
+                    exhausted = True
+                    return
+                in_flight[pool.submit(fetch_with_reason, id_number, session, limiter, stop)] = id_number
+
+        top_up()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield (in_flight.pop(future), *future.result())
+            top_up()
+
 def parse_data(records, all_hospitals, all_addresses, all_doctors):
     if not isinstance(records, list):
         records = [records]
@@ -274,8 +1220,8 @@ def parse_data(records, all_hospitals, all_addresses, all_doctors):
         if addrs and isinstance(addrs, list):
             for ad in addrs:
                 raw_full_addr = ad.get('fulladdress', '')
-                # Apply the V16 Singularity Cleaner here!
-                clean_addr = clean_bg_address(raw_full_addr)
+                # Apply the V16 Singularity Cleaner here! (memoized - duplicate addresses are cleaned once)
+                clean_addr = ADDRESS_CACHE.get(raw_full_addr)
                 
                 addr_specs = ad.get('specialities', [])
                 addr_spec_str = ", ".join([s.get('label', '') for s in addr_specs]) if addr_specs else ""
@@ -289,6 +1235,8 @@ def parse_data(records, all_hospitals, all_addresses, all_doctors):
                     'City': ad.get('ekatte'),
                     'Full_Address': raw_full_addr,
                     'Full_Address_Clean': clean_addr,
+                    # Canonical location ID - what geocoding dedups on (see AddressIndex)
+                    'Address_ID': ADDRESS_INDEX.address_id(clean_addr, ad.get('ekatte'), ad.get('district'), ad.get('munincipaliti')),
                     'Address_Specialties': addr_spec_str,
                     'Address_Activities': addr_act_str,
                     'Region': ad.get('district'),
@@ -324,86 +1272,1037 @@ def parse_data(records, all_hospitals, all_addresses, all_doctors):
         else:
             all_doctors.append({'Hospital_ID': h_id, 'Doctor_Name': 'N/A'})
 
-def save_multisheet_excel(hospitals, addresses, doctors):
+def write_part_file(path, header, items):
+    """Commit header + [sheet, row] lines, written to a temp file, fsynced and renamed into place."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", 'w', encoding='utf-8') as f:
+        f.write(json.dumps([COMMIT_MARKER, header], ensure_ascii=False) + "\n")
+        f.writelines(json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+class PartSink:
+    """Buffers parsed rows per finished ID and flushes them in chunks to numbered JSONL part files.
+    Each part is written to a temp file, fsynced and renamed into place, then the `stores` (raw store,
+    registry) get committed, then its IDs. A done ID always has its response and registry rows on disk."""
+
+    def __init__(self, checkpoint, parts_dir=PARTS_DIR, chunk_rows=SINK_CHUNK_ROWS,
+                 chunk_ids=CHECKPOINT_EVERY_IDS, chunk_seconds=CHECKPOINT_EVERY_SECONDS, stores=()):
+        self.checkpoint = checkpoint
+        self.stores = [store for store in stores if store]
+        self.parts_dir = parts_dir
+        self.chunk_rows = chunk_rows
+        self.chunk_ids = chunk_ids
+        self.chunk_seconds = chunk_seconds
+        self.buffer = []
+        self.done_ids = []
+        self.failed = {}
+        self.retries = {}
+        self.last_flush = time.monotonic()
+        self.part_seq = 0
+        self.row_counts = {sheet: 0 for sheet, _ in SHEETS}
+        self.bytes_written = 0 # What the final save will have to chew through (see TimeBudget)
+
+    def add(self, id_val, hospitals, addresses, doctors):
+        for sheet, rows in (('Hospitals', hospitals), ('Addresses', addresses), ('Doctors', doctors)):
+            self.buffer.extend((sheet, row) for row in rows)
+            self.row_counts[sheet] += len(rows)
+        self.done_ids.append(id_val)
+        self._maybe_flush()
+
+    def add_failure(self, id_val, reason):
+        self.failed[id_val] = reason
+        self._maybe_flush()
+
+    def add_retry(self, id_val, reason):
+        self.retries[id_val] = reason
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if (len(self.buffer) >= self.chunk_rows
+                or len(self.done_ids) + len(self.failed) + len(self.retries) >= self.chunk_ids
+                or time.monotonic() - self.last_flush >= self.chunk_seconds):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if not (self.buffer or self.done_ids or self.failed or self.retries):
+            return
+        self.part_seq += 1
+        path = os.path.join(self.parts_dir, f"part_{self.part_seq:05d}.jsonl")
+        with METRICS.timer('checkpoint'):
+            write_part_file(path, {'done': self.done_ids, 'failed': self.failed, 'retry': self.retries}, self.buffer)
+            for store in self.stores:
+                store.commit()
+            # Rows, responses and registry are durable - now (and only now) the IDs count as done
+            self.checkpoint.commit(self.done_ids, self.failed, self.retries)
+        self.bytes_written += os.path.getsize(path)
+        self.buffer = []
+        self.done_ids = []
+        self.failed = {}
+        self.retries = {}
+
+def find_part_dirs(parts_root=PARTS_ROOT):
+    """Every run's part directory, oldest first (leftovers from killed runs included)."""
+    return sorted(d for d in glob.glob(os.path.join(parts_root, "*")) if os.path.isdir(d))
+
+def iter_part_rows(part_dirs, sheet):
+    """Streams one sheet's rows back out of the part files, in write order."""
+    for part_dir in part_dirs:
+        for path in sorted(glob.glob(os.path.join(part_dir, "part_*.jsonl"))):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    row_sheet, row = json.loads(line)
+                    if row_sheet == sheet: # Skips the commit header too
+                        yield row
+
+def _write_workbook(row_iters, output_file, sheets=SHEETS):
+    wb = Workbook(write_only=True)
+    for (sheet, columns), rows in zip(sheets, row_iters):
+        ws = wb.create_sheet(sheet)
+        ws.append(columns)
+        for row in rows:
+            ws.append([row.get(col) for col in columns])
+    wb.save(output_file)
+
+def save_multisheet_excel(hospitals, addresses, doctors, output_file=None, sheets=SHEETS, unique_addresses=None):
+    """Writes the three sheets with a write_only workbook - rows are streamed, so any iterable of dicts works.
+    `unique_addresses` (rows of UNIQUE_ADDRESS_COLUMNS) becomes a fourth sheet."""
+    output_file = output_file or OUTPUT_FILE
+    row_iters = [hospitals, addresses, doctors]
+    if unique_addresses is not None:
+        row_iters.append(unique_addresses)
+        sheets = list(sheets) + [(UNIQUE_ADDRESS_SHEET, UNIQUE_ADDRESS_COLUMNS)]
     try:
-        df_h = pd.DataFrame(hospitals)
-        df_a = pd.DataFrame(addresses)
-        df_d = pd.DataFrame(doctors)
-
-        with pd.ExcelWriter(OUTPUT_FILE, engine='openpyxl') as writer:
-            df_h.to_excel(writer, sheet_name='Hospitals', index=False)
-            df_a.to_excel(writer, sheet_name='Addresses', index=False)
-            df_d.to_excel(writer, sheet_name='Doctors', index=False)
-        print(f"SAVED BATCH: {OUTPUT_FILE}")
+        with METRICS.timer('save'):
+            _write_workbook(row_iters, output_file, sheets)
+        print(f"SAVED BATCH: {output_file}")
+        return True
     except Exception as e:
         print(f"!!! CRITICAL: Failed to save Excel: {e}")
+        return False
+
+def consolidate_parts(part_dirs, output_file=None):
+    """Merges part files into the final workbook (+ Unique_Addresses), then clears the parts that made it in."""
+    if not part_dirs:
+        return False
+    saved = save_multisheet_excel(*(iter_part_rows(part_dirs, sheet) for sheet, _ in SHEETS), output_file=output_file,
+                                  unique_addresses=AddressIndex.unique_rows(iter_part_rows(part_dirs, 'Addresses')))
+    if saved:
+        for part_dir in part_dirs:
+            shutil.rmtree(part_dir, ignore_errors=True)
+    return saved
+
+def _dir_megabytes(part_dirs):
+    return sum(entry.stat().st_size for d in part_dirs if os.path.isdir(d) for entry in os.scandir(d)) / 1e6
+
+def probe_save_seconds_per_mb(part_dirs):
+    """Times the final-save path (parts -> xlsx, in memory) on what we have so far. The cost is linear in the parts."""
+    megabytes = _dir_megabytes(part_dirs)
+    t0 = time.perf_counter()
+    _write_workbook([*(iter_part_rows(part_dirs, sheet) for sheet, _ in SHEETS),
+                     AddressIndex.unique_rows(iter_part_rows(part_dirs, 'Addresses'))],
+                    io.BytesIO(), SHEETS + [(UNIQUE_ADDRESS_SHEET, UNIQUE_ADDRESS_COLUMNS)])
+    return time.perf_counter() - t0, megabytes
 
-def main_loop():
-    # 1. Load targets
-    all_ids = load_ids_from_col_b()
+def main_loop(input_path=INPUT_FILE_PATH, shard=None):
+    shard = shard or Shard(0, 1)
+    parts_root = shard.path(PARTS_ROOT)
+    output_file = shard.path(OUTPUT_FILE)
+
+    # 1. Load targets (only our slice when sharded)
+    all_ids = load_ids_from_col_b(input_path)
+    if shard.count > 1:
+        all_ids = [x for x in all_ids if shard.owns(x)]
+        print(f"Running as {shard}: {len(all_ids)} ID-chovtsi are ours.")
     
-    # 2. Load already done IDs
-    processed_ids = get_processed_ids()
-    print(f"History check: We have already roasted {len(processed_ids)} ID-chovtsi.")
+    # 2. Load already done IDs (replaying any part files a killed run left behind)
+    checkpoint = Checkpoint(shard.path(PROCESSED_LOG_FILE), shard.path(FAILED_LOG_FILE), shard.path(RETRY_QUEUE_FILE), shard)
+    checkpoint.recover(find_part_dirs(parts_root))
+    print(f"History check: We have already roasted {len(checkpoint.done)} ID-chovtsi "
+          f"({len(checkpoint.failed)} failed, {len(checkpoint.retry)} waiting for a retry).")
 
-    # 3. Filter list
-    pending_ids = [x for x in all_ids if x not in processed_ids]
+    # 3. Filter list - retries that are already due go first, the rest wait for the end-of-run drain
+    due_retries = checkpoint.retry.due()
+    pending_ids = due_retries + [x for x in all_ids if not checkpoint.is_settled(x) and x not in checkpoint.retry]
     total_pending = len(pending_ids)
     
-    if total_pending == 0:
+    if total_pending == 0 and not len(checkpoint.retry):
         print("Nothing left to do. Ez clap. GG WP.")
+        if find_part_dirs(parts_root):
+            consolidate_parts(find_part_dirs(parts_root), output_file)
         return
 
-    print(f"--- STARTING BATCH (Targets Left: {total_pending}) ---")
-    
-    all_hospitals = []
-    all_addresses = []
-    all_doctors = []
+    print(f"--- STARTING BATCH (Targets Left: {total_pending}, {len(due_retries)} of them retries) ---")
     
+    leftover_mb = _dir_megabytes(find_part_dirs(parts_root)) # A killed run's parts get saved with ours
     batch_counter = 0
-    save_interval = 100 # Optional: intermediate in-memory flush if needed, but we rely on huge batch at end or timeout
-    
-    for i, id_number in enumerate(pending_ids):
+    time_limit_hit = False
+    budget = TimeBudget(SAVE_SECONDS_PER_MB)
+    budget.install_signal_handlers()
+
+    def save_mb():
+        return leftover_mb + sink.bytes_written / 1e6
+
+    def out_of_time():
+        nonlocal time_limit_hit
         # --- TIME CHECK ---
-        elapsed = time.time() - START_TIME
-        if elapsed > MAX_RUNTIME_SECONDS:
-            print("\n!!! TIME LIMIT REACHED !!!")
-            print("Initiating emergency save protocol. Skibidi bop mm dada.")
-            
-            # Create a flag file to tell GitHub to restart
-            with open(CONTINUE_FLAG_FILE, 'w') as f:
-                f.write("MORE_BLOOD")
-            
-            break # Break the loop to save and exit
-
-        # --- LOGIC ---
-        percent_done = ((i + 1) / total_pending) * 100
-        print(f"[{i+1}/{total_pending}] >> {percent_done:.2f}% << Processing: {id_number}...")
-        
-        data = fetch_details(id_number)
-        
+        # Not "past the limit" but "the drain + last checkpoint + final save would no longer fit"
+        if budget.should_stop(save_mb()):
+            time_limit_hit = True
+        return time_limit_hit
+
+    try:
+        ADDRESS_CACHE.open_disk(shard.path(ADDRESS_CACHE_FILE))
+    except sqlite3.Error as e:
+        print(f"Address cache on disk is cooked ({e}), running memory-only.")
+
+    raw_store = _open_raw_store(shard.path(RAW_STORE_FILE))
+    registry = _open_registry(shard.path(REGISTRY_DB_FILE))
+    sink = PartSink(checkpoint, os.path.join(parts_root, TIMESTAMP), stores=(raw_store, registry))
+    session = make_session(CONCURRENCY)
+    limiter = AdaptiveRateLimiter()
+    print(f"Fetch engine: {CONCURRENCY} workers, starting at {limiter.rate:.2f} req/s (max {limiter.max_rate:.2f}).")
+
+    def handle(id_number, data, failure):
+        nonlocal batch_counter
         if data:
-            parse_data(data, all_hospitals, all_addresses, all_doctors)
-            # Log as done only after parsing
-            save_processed_id(id_number)
+            if raw_store:
+                raw_store.put(id_number, data) # Before parsing - a parser bug must not cost us the response
+            hospitals, addresses, doctors = [], [], []
+            try:
+                with METRICS.timer('parse'):
+                    parse_data(data, hospitals, addresses, doctors)
+            except Exception as e:
+                sink.add_failure(id_number, f"Parse error: {type(e).__name__}: {e}")
+                METRICS.id_finished('failed')
+                print(f"    [-] Parser tripped on {id_number}: {e}")
+                return
+            if registry:
+                with METRICS.timer('registry'):
+                    registry.upsert(data)
+            # Committed as done together with its rows when the chunk hits the disk (add() may flush right away)
+            sink.add(id_number, hospitals, addresses, doctors)
+            METRICS.id_finished('done')
             batch_counter += 1
-            print(f"    [+] Data Acquired.")
+            if not budget.save_probed and sink.bytes_written >= SAVE_PROBE_BYTES:
+                budget.learn_save(*probe_save_seconds_per_mb([sink.parts_dir]))
+                print(f"Save probe: {budget.save_seconds_per_unit:.2f}s per MB of parts "
+                      f"(final save now ~{budget.save_estimate(save_mb()):.0f}s).")
+        elif failure[0] == TRANSIENT:
+            # Blip, 503 burst, WAF tantrum - back in the queue with backoff instead of lost forever
+            sink.add_retry(id_number, failure[1])
+            METRICS.id_finished('retry')
         else:
-            # Even if 404 or Error, mark as processed so we don't retry forever
-            # Or maybe you want to retry? Assuming we skip bad ones:
-            save_processed_id(id_number)
-            print(f"    [-] Skipped.")
-        
-        # Sleep to avoid WAF ban-chovtsi
-        sleep_time = random.uniform(0.5, 1.2)
-        time.sleep(sleep_time)
+            # Real 404 or a permanent error - settled, logged as a failure with the reason
+            sink.add_failure(id_number, failure[1])
+            METRICS.id_finished('failed')
+
+    # --- LOGIC ---
+    # No line per ID anymore - a status line every PROGRESS_EVERY_SECONDS (rate, outcomes, ETA vs the time budget)
+    i = 0
+    for i, (id_number, data, failure) in enumerate(fetch_many(pending_ids, session, limiter, CONCURRENCY, out_of_time, budget.interrupted), 1):
+        handle(id_number, data, failure)
+        METRICS.progress(i, total_pending, limiter)
+    METRICS.progress(i, total_pending, limiter, force=True)
+
+    # --- RETRY DRAIN ---
+    # Whatever is still in the queue gets its backoff honoured; what doesn't come due in time waits for the next run
+    sink.flush()
+    while len(checkpoint.retry) and not out_of_time():
+        due = checkpoint.retry.due()
+        if not due:
+            wait_for = checkpoint.retry.seconds_until_next()
+            if wait_for > min(RETRY_DRAIN_MAX_WAIT, budget.work_seconds_left(save_mb())):
+                break
+            print(f"Retry queue: {len(checkpoint.retry)} waiting, next one due in {wait_for:.0f}s...")
+            budget.wait(wait_for)
+            continue
+        print(f"Retry queue: draining {len(due)} due ID-chovtsi...")
+        for i, (id_number, data, failure) in enumerate(fetch_many(due, session, limiter, CONCURRENCY, out_of_time, budget.interrupted), 1):
+            handle(id_number, data, failure)
+            METRICS.progress(i, len(due), limiter, label="retry drain ")
+        sink.flush()
+
+    session.close()
+    sink.flush()
+    if raw_store:
+        raw_store.close()
+    if registry:
+        registry.close()
+    ADDRESS_CACHE.close()
+    print(ADDRESS_CACHE.stats())
+    if len(checkpoint.retry):
+        print(f"Retry queue: {len(checkpoint.retry)} ID-chovtsi carried over to the next run.")
+
+    if time_limit_hit:
+        print(f"\n!!! {'TIME LIMIT REACHED' if not budget.interrupted.is_set() else 'STOP REQUESTED'} ({budget.stop_reason}) !!!")
+        print(f"In-flight requests drained with {_fmt_duration(budget.deadline - time.time())} left. "
+              f"Initiating emergency save protocol. Skibidi bop mm dada.")
+
+    if time_limit_hit or len(checkpoint.retry):
+        # Create a flag file to tell GitHub to restart - queued retries need a next run even if we finished early
+        with open(CONTINUE_FLAG_FILE, 'w') as f:
+            f.write("MORE_BLOOD")
 
     # --- FINAL SAVE FOR THIS RUN ---
-    if all_hospitals:
-        print("Saving harvested soul-chovtsi to Excel...")
-        save_multisheet_excel(all_hospitals, all_addresses, all_doctors)
+    # Parts left behind by a killed run get folded into this batch too
+    part_dirs = find_part_dirs(parts_root)
+    if part_dirs and budget.interrupted.is_set() and budget.save_estimate(save_mb()) > SIGNAL_SAVE_GRACE_SECONDS:
+        # Being killed - everything is checkpointed, the next run folds these parts into its workbook
+        print(f"No time for the workbook (~{budget.save_estimate(save_mb()):.0f}s), {len(part_dirs)} part dir(s) kept for the next run.")
+    elif part_dirs:
+        print(f"Saving harvested soul-chovtsi to Excel ({sink.row_counts['Hospitals']} hospital rows this run, {len(part_dirs)} part dir(s))...")
+        consolidate_parts(part_dirs, output_file)
     else:
         print("No valid data found in this batch. L.")
+    METRICS.report(shard.path(PERF_REPORT_FILE), mode='scrape', shard=str(shard), ids_pending=total_pending,
+                   time_limit_hit=time_limit_hit, stop_reason=budget.stop_reason, retry_carried_over=len(checkpoint.retry),
+                   save_seconds_per_mb=round(budget.save_seconds_per_unit, 3), save_probed=budget.save_probed,
+                   final_rate=round(limiter.rate, 2), throttle_events=limiter.throttle_count,
+                   address_cache=_address_cache_counts())
+
+class RawStore:
+    """Raw API responses keyed by ID, zlib-compressed in SQLite. Latest fetch wins."""
+
+    def __init__(self, path=RAW_STORE_FILE, commit_every=CHECKPOINT_EVERY_IDS):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (id TEXT PRIMARY KEY, fetched_at REAL, body BLOB)")
+        self.db.commit()
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+    def put(self, id_val, data):
+        body = zlib.compress(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (id_val, time.time(), body))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def get(self, id_val):
+        row = self.db.execute("SELECT body FROM responses WHERE id = ?", (id_val,)).fetchone()
+        return json.loads(zlib.decompress(row[0])) if row else None
+
+    def count(self):
+        return self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def iter_chunks(self, size=REPARSE_CHUNK):
+        """Lists of (id, compressed body) in ID order - decompression is the workers' problem."""
+        cursor = self.db.execute("SELECT id, body FROM responses ORDER BY id")
+        while True:
+            chunk = cursor.fetchmany(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def _open_raw_store(path=RAW_STORE_FILE):
+    try:
+        return RawStore(path)
+    except sqlite3.Error as e:
+        print(f"Raw response store is cooked ({e}), responses won't be kept this run.")
+        return None
+
+REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hospitals (
+    id TEXT PRIMARY KEY, old_number TEXT, name TEXT, status TEXT, reg_date TEXT, vid_lz TEXT,
+    content_hash TEXT, first_seen REAL, last_seen REAL, removed_at REAL);
+CREATE TABLE IF NOT EXISTS owners (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS hospital_owners (
+    hospital_id TEXT NOT NULL REFERENCES hospitals(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL, owner_id INTEGER NOT NULL REFERENCES owners(id), PRIMARY KEY (hospital_id, seq));
+CREATE TABLE IF NOT EXISTS specialties (id INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS activities (id INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE);
+-- One row per distinct location (AddressIndex) - geocoders hang their coordinates off this
+CREATE TABLE IF NOT EXISTS canonical_addresses (
+    id TEXT PRIMARY KEY, ekatte TEXT, district TEXT, municipality TEXT, normalized TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS addresses (
+    id INTEGER PRIMARY KEY, hospital_id TEXT NOT NULL REFERENCES hospitals(id) ON DELETE CASCADE, seq INTEGER NOT NULL,
+    type TEXT, ekatte TEXT, full_address TEXT, full_address_clean TEXT, district TEXT, municipality TEXT,
+    canonical_id TEXT REFERENCES canonical_addresses(id), UNIQUE (hospital_id, seq));
+CREATE TABLE IF NOT EXISTS address_specialties (
+    address_id INTEGER NOT NULL REFERENCES addresses(id) ON DELETE CASCADE, seq INTEGER NOT NULL,
+    specialty_id INTEGER NOT NULL REFERENCES specialties(id), PRIMARY KEY (address_id, seq));
+CREATE TABLE IF NOT EXISTS address_activities (
+    address_id INTEGER NOT NULL REFERENCES addresses(id) ON DELETE CASCADE, seq INTEGER NOT NULL,
+    activity_id INTEGER NOT NULL REFERENCES activities(id), PRIMARY KEY (address_id, seq));
+CREATE TABLE IF NOT EXISTS doctors (id INTEGER PRIMARY KEY, name TEXT NOT NULL, type TEXT NOT NULL DEFAULT '', UNIQUE (name, type));
+CREATE TABLE IF NOT EXISTS staff (
+    id INTEGER PRIMARY KEY, hospital_id TEXT NOT NULL REFERENCES hospitals(id) ON DELETE CASCADE, seq INTEGER NOT NULL,
+    doctor_id INTEGER NOT NULL REFERENCES doctors(id), UNIQUE (hospital_id, seq));
+CREATE TABLE IF NOT EXISTS staff_specialties (
+    staff_id INTEGER NOT NULL REFERENCES staff(id) ON DELETE CASCADE, seq INTEGER NOT NULL,
+    specialty_id INTEGER NOT NULL REFERENCES specialties(id), PRIMARY KEY (staff_id, seq));
+
+CREATE INDEX IF NOT EXISTS idx_addresses_ekatte ON addresses (ekatte);
+CREATE INDEX IF NOT EXISTS idx_addresses_district ON addresses (district, municipality);
+CREATE INDEX IF NOT EXISTS idx_addresses_canonical ON addresses (canonical_id);
+CREATE INDEX IF NOT EXISTS idx_address_specialties_specialty ON address_specialties (specialty_id);
+CREATE INDEX IF NOT EXISTS idx_staff_doctor ON staff (doctor_id);
+CREATE INDEX IF NOT EXISTS idx_staff_specialties_specialty ON staff_specialties (specialty_id);
+CREATE INDEX IF NOT EXISTS idx_hospital_owners_owner ON hospital_owners (owner_id);
+"""
+# Views are recreated on every open, so a DB from an older version picks up new columns
+REGISTRY_VIEWS_SQL = """
+-- The workbook sheets, same columns as SHEETS (facilities without addresses/staff get no N/A filler rows)
+DROP VIEW IF EXISTS v_hospitals;
+CREATE VIEW v_hospitals AS
+    SELECT h.id AS Hospital_ID, h.old_number AS Old_Number, h.name AS Name, h.status AS Status,
+           h.reg_date AS Reg_Date, h.vid_lz AS Vid_LZ, COALESCE(o.name, 'N/A') AS Managers
+    FROM hospitals h
+    LEFT JOIN hospital_owners ho ON ho.hospital_id = h.id LEFT JOIN owners o ON o.id = ho.owner_id
+    WHERE h.removed_at IS NULL ORDER BY h.id, ho.seq;
+DROP VIEW IF EXISTS v_addresses;
+CREATE VIEW v_addresses AS
+    SELECT a.hospital_id AS Hospital_ID, a.type AS Type, a.ekatte AS City, a.full_address AS Full_Address,
+           a.full_address_clean AS Full_Address_Clean, a.canonical_id AS Address_ID,
+           COALESCE((SELECT group_concat(label, ', ') FROM (SELECT s.label FROM address_specialties x
+                     JOIN specialties s ON s.id = x.specialty_id WHERE x.address_id = a.id ORDER BY x.seq)), '') AS Address_Specialties,
+           COALESCE((SELECT group_concat(label, ', ') FROM (SELECT t.label FROM address_activities x
+                     JOIN activities t ON t.id = x.activity_id WHERE x.address_id = a.id ORDER BY x.seq)), '') AS Address_Activities,
+           a.district AS Region, a.municipality AS Municipality
+    FROM addresses a JOIN hospitals h ON h.id = a.hospital_id
+    WHERE h.removed_at IS NULL ORDER BY a.hospital_id, a.seq;
+DROP VIEW IF EXISTS v_doctors;
+CREATE VIEW v_doctors AS
+    SELECT st.hospital_id AS Hospital_ID, d.name AS Doctor_Name, NULLIF(d.type, '') AS Type,
+           COALESCE((SELECT group_concat(label, ', ') FROM (SELECT s.label FROM staff_specialties x
+                     JOIN specialties s ON s.id = x.specialty_id WHERE x.staff_id = st.id ORDER BY x.seq)), '') AS Specialty
+    FROM staff st JOIN doctors d ON d.id = st.doctor_id JOIN hospitals h ON h.id = st.hospital_id
+    WHERE h.removed_at IS NULL ORDER BY st.hospital_id, st.seq;
+-- Unique_Addresses: live locations only, most frequent spelling (ties: shortest, then alphabetical)
+DROP VIEW IF EXISTS v_unique_addresses;
+CREATE VIEW v_unique_addresses AS
+    SELECT c.id AS Address_ID, c.ekatte AS City, c.district AS Region, c.municipality AS Municipality,
+           (SELECT x.full_address_clean FROM addresses x JOIN hospitals hx ON hx.id = x.hospital_id
+            WHERE x.canonical_id = c.id AND hx.removed_at IS NULL GROUP BY x.full_address_clean
+            ORDER BY COUNT(*) DESC, LENGTH(x.full_address_clean), x.full_address_clean LIMIT 1) AS Full_Address_Clean,
+           COUNT(*) AS Occurrences
+    FROM canonical_addresses c JOIN addresses a ON a.canonical_id = c.id JOIN hospitals h ON h.id = a.hospital_id
+    WHERE h.removed_at IS NULL GROUP BY c.id
+    ORDER BY COALESCE(c.district, ''), COALESCE(c.municipality, ''), COALESCE(c.ekatte, ''), c.id;
+"""
+REGISTRY_VIEWS = {'Hospitals': 'v_hospitals', 'Addresses': 'v_addresses', 'Doctors': 'v_doctors',
+                  UNIQUE_ADDRESS_SHEET: 'v_unique_addresses'}
+
+def _full_name(person):
+    return f"{person.get('firstname', '')} {person.get('middlename', '')} {person.get('lastname', '')}".strip()
+
+def _labels(items):
+    return [item.get('label', '') for item in items if isinstance(item, dict)] if isinstance(items, list) else []
+
+class RegistryStore:
+    """Normalized SQLite copy of the registry. A facility is upserted as a whole (its owners/addresses/staff
+    are replaced), doctors/owners/specialties are shared across facilities and runs.
+
+    "All cardiologists in Plovdiv district" is then one indexed query:
+        SELECT DISTINCT d.name FROM specialties s JOIN staff_specialties x ON x.specialty_id = s.id
+        JOIN staff st ON st.id = x.staff_id JOIN doctors d ON d.id = st.doctor_id
+        JOIN addresses a ON a.hospital_id = st.hospital_id WHERE s.label = 'Кардиология' AND a.district = 'Пловдив'
+    """
+
+    def __init__(self, path=REGISTRY_DB_FILE, commit_every=CHECKPOINT_EVERY_IDS):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA foreign_keys=ON")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(addresses)")]
+        if columns and 'canonical_id' not in columns: # Registry from before the address index
+            self.db.execute("ALTER TABLE addresses ADD COLUMN canonical_id TEXT REFERENCES canonical_addresses(id)")
+        self.db.executescript(REGISTRY_SCHEMA + REGISTRY_VIEWS_SQL)
+        self.db.commit()
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.label_ids = {} # (table, key) -> id, the lookup tables only ever grow
+        # Goes into the stored hash, so rows cleaned/keyed by older logic don't pass as unchanged
+        self.derived_version = f"{ADDRESS_NORMALIZER.fingerprint}:{ADDRESS_INDEX_VERSION}"
+        self.canonical_ids = set() # Already in canonical_addresses
+        self._backfill_canonical_ids()
+
+    def _canonical_id(self, clean, ekatte, district, municipality):
+        found = ADDRESS_INDEX.canonical(clean, ekatte, district, municipality)
+        if not found:
+            return None
+        address_id, normalized = found
+        if address_id not in self.canonical_ids:
+            self.db.execute("INSERT OR IGNORE INTO canonical_addresses VALUES (?, ?, ?, ?, ?)",
+                            (address_id, ekatte, district, municipality, normalized))
+            self.canonical_ids.add(address_id)
+        return address_id
+
+    def _backfill_canonical_ids(self):
+        """Unchanged facilities skip the upsert, so rows stored before the address index get their IDs here."""
+        rows = self.db.execute("SELECT id, full_address_clean, ekatte, district, municipality FROM addresses "
+                               "WHERE canonical_id IS NULL").fetchall()
+        updates = [(self._canonical_id(*row[1:]), row[0]) for row in rows]
+        updates = [update for update in updates if update[0]]
+        if updates:
+            self.db.executemany("UPDATE addresses SET canonical_id = ? WHERE id = ?", updates)
+            print(f"Registry: backfilled {len(updates)} canonical address IDs.")
+        self.db.commit()
+
+    def _lookup_id(self, table, column_values):
+        key = (table, column_values)
+        cached = self.label_ids.get(key)
+        if cached is None:
+            columns = {'owners': ('name',), 'specialties': ('label',), 'activities': ('label',), 'doctors': ('name', 'type')}[table]
+            where = " AND ".join(f"{c} = ?" for c in columns)
+            self.db.execute(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})", column_values)
+            cached = self.label_ids[key] = self.db.execute(f"SELECT id FROM {table} WHERE {where}", column_values).fetchone()[0]
+        return cached
+
+    def upsert(self, data, now=None, force=False):
+        """Stores every facility in a raw API response. Unchanged ones only get their last_seen bumped, unless `force`.
+        "Unchanged" covers the derived columns too: a cleaner or address-key bump changes the hash."""
+        now = time.time() if now is None else now
+        for rec in (data if isinstance(data, list) else [data]):
+            h_id = rec.get('number') if isinstance(rec, dict) else None
+            if not h_id:
+                continue
+            content_hash = _content_hash([rec, self.derived_version])
+            old = self.db.execute("SELECT content_hash FROM hospitals WHERE id = ?", (h_id,)).fetchone()
+            if old and old[0] == content_hash and not force:
+                self.db.execute("UPDATE hospitals SET last_seen = ?, removed_at = NULL WHERE id = ?", (now, h_id))
+                continue
+            vid = rec.get('vid')
+            self.db.execute("""INSERT INTO hospitals (id, old_number, name, status, reg_date, vid_lz, content_hash, first_seen, last_seen)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                               ON CONFLICT (id) DO UPDATE SET old_number = excluded.old_number, name = excluded.name,
+                               status = excluded.status, reg_date = excluded.reg_date, vid_lz = excluded.vid_lz,
+                               content_hash = excluded.content_hash, last_seen = excluded.last_seen, removed_at = NULL""",
+                            (h_id, rec.get('oldNumber'), rec.get('name'), rec.get('statuslabel'), rec.get('registrationDate'),
+                             vid.get('label') if isinstance(vid, dict) else vid, content_hash, now, now))
+            # Children are a snapshot of this response - the cascades clear the link tables too
+            for table in ('hospital_owners', 'addresses', 'staff'):
+                self.db.execute(f"DELETE FROM {table} WHERE hospital_id = ?", (h_id,))
+
+            owners = rec.get('owners')
+            if isinstance(owners, list):
+                self.db.executemany("INSERT INTO hospital_owners VALUES (?, ?, ?)",
+                                    [(h_id, seq, self._lookup_id('owners', (_full_name(o),))) for seq, o in enumerate(owners)])
+
+            addrs = rec.get('address')
+            for seq, ad in enumerate(addrs if isinstance(addrs, list) else []):
+                raw_full_addr = ad.get('fulladdress', '')
+                clean_addr = ADDRESS_CACHE.get(raw_full_addr)
+                place = (ad.get('ekatte'), ad.get('district'), ad.get('munincipaliti'))
+                address_id = self.db.execute(
+                    "INSERT INTO addresses (hospital_id, seq, type, ekatte, full_address, full_address_clean, district, "
+                    "municipality, canonical_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (h_id, seq, ad.get('typeaddresslabel'), place[0], raw_full_addr, clean_addr, place[1], place[2],
+                     self._canonical_id(clean_addr, *place))).lastrowid
+                self.db.executemany("INSERT INTO address_specialties VALUES (?, ?, ?)",
+                                    [(address_id, i, self._lookup_id('specialties', (label,))) for i, label in enumerate(_labels(ad.get('specialities')))])
+                self.db.executemany("INSERT INTO address_activities VALUES (?, ?, ?)",
+                                    [(address_id, i, self._lookup_id('activities', (label,))) for i, label in enumerate(_labels(ad.get('activities')))])
+
+            staff = rec.get('medicalStaff')
+            for seq, doc in enumerate(staff if isinstance(staff, list) else []):
+                # Same name + type = same doctor - the API has no personal ID to do better
+                doctor_id = self._lookup_id('doctors', (_full_name(doc), doc.get('typelabel') or ''))
+                staff_id = self.db.execute("INSERT INTO staff (hospital_id, seq, doctor_id) VALUES (?, ?, ?)",
+                                           (h_id, seq, doctor_id)).lastrowid
+                self.db.executemany("INSERT INTO staff_specialties VALUES (?, ?, ?)",
+                                    [(staff_id, i, self._lookup_id('specialties', (label,))) for i, label in enumerate(_labels(doc.get('specialities')))])
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def prune_canonical(self):
+        """Drops canonical addresses nothing points at anymore (re-keyed or gone). -> rows removed"""
+        removed = self.db.execute("DELETE FROM canonical_addresses WHERE id NOT IN "
+                                  "(SELECT canonical_id FROM addresses WHERE canonical_id IS NOT NULL)").rowcount
+        self.canonical_ids.clear()
+        return removed
+
+    def mark_removed(self, id_val, now=None):
+        """Gone from the registry - kept for history, hidden from the views."""
+        self.db.execute("UPDATE hospitals SET removed_at = ? WHERE id = ? AND removed_at IS NULL",
+                        (time.time() if now is None else now, id_val))
+
+    def iter_view(self, sheet):
+        cursor = self.db.execute(f"SELECT * FROM {REGISTRY_VIEWS[sheet]}")
+        columns = [c[0] for c in cursor.description]
+        for row in cursor:
+            yield dict(zip(columns, row))
+
+    def counts(self):
+        return {table: self.db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ('hospitals', 'owners', 'addresses', 'canonical_addresses', 'doctors', 'staff', 'specialties')}
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+def _open_registry(path=REGISTRY_DB_FILE):
+    try:
+        return RegistryStore(path)
+    except sqlite3.Error as e:
+        print(f"Registry DB is cooked ({e}), only the workbook gets written this run.")
+        return None
+
+def export_registry(output_file=REGISTRY_EXPORT_FILE, rebuild=False):
+    """Writes the registry views as a workbook. `rebuild` first replaces every facility from the raw store
+    (forced - same responses, but the cleaner/address key may have moved on since they were stored)."""
+    registry = RegistryStore()
+    if rebuild:
+        store = RawStore()
+        for chunk in store.iter_chunks():
+            for id_val, body in chunk:
+                registry.upsert(json.loads(zlib.decompress(body)), force=True)
+        store.close()
+        pruned = registry.prune_canonical()
+        if pruned:
+            print(f"Registry: pruned {pruned} canonical addresses no facility uses anymore.")
+        registry.commit()
+    print(f"Registry: {registry.counts()}")
+    saved = save_multisheet_excel(*(registry.iter_view(sheet) for sheet, _ in SHEETS), output_file=output_file,
+                                  unique_addresses=registry.iter_view(UNIQUE_ADDRESS_SHEET))
+    registry.close()
+    return saved
+
+def _reparse_chunk(task):
+    """Worker: decompress + parse one chunk of stored responses straight into its own part file."""
+    seq, chunk, parts_dir = task
+    items, done, failed = [], [], {}
+    for id_val, body in chunk:
+        hospitals, addresses, doctors = [], [], []
+        try:
+            parse_data(json.loads(zlib.decompress(body)), hospitals, addresses, doctors)
+        except Exception as e:
+            failed[id_val] = f"Parse error: {type(e).__name__}: {e}"
+            continue
+        done.append(id_val)
+        for sheet, rows in (('Hospitals', hospitals), ('Addresses', addresses), ('Doctors', doctors)):
+            items.extend((sheet, row) for row in rows)
+    write_part_file(os.path.join(parts_dir, f"part_{seq:05d}.jsonl"), {'done': done, 'failed': failed}, items)
+    return len(done), failed
+
+def reparse_loop(workers=None, output_file=REPARSED_FILE):
+    """Rebuilds Hospitals/Addresses/Doctors from the raw store across all CPU cores. No network."""
+    t0 = time.perf_counter()
+    store = RawStore()
+    total = store.count()
+    if not total:
+        print(f"Raw store {RAW_STORE_FILE} is empty. Scrape something first, lyolyo.")
+        store.close()
+        return False
+    workers = workers or os.cpu_count() or 1
+    parts_dir = os.path.join(REPARSE_PARTS_ROOT, TIMESTAMP)
+    print(f"Reparsing {total} stored responses on {workers} cores...")
+
+    parsed, failed = 0, {}
+    tasks = ((seq, chunk, parts_dir) for seq, chunk in enumerate(store.iter_chunks(REPARSE_CHUNK), 1))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for n_ok, chunk_failed in pool.map(_reparse_chunk, tasks):
+            parsed += n_ok
+            failed.update(chunk_failed)
+    store.close()
+
+    for id_val, reason in list(failed.items())[:10]:
+        print(f"    [-] {id_val}: {reason}")
+    print(f"Parsed {parsed}/{total} in {time.perf_counter() - t0:.1f}s ({len(failed)} parse failures).")
+    saved = consolidate_parts([parts_dir], output_file=output_file)
+    print(f"Reparse done in {time.perf_counter() - t0:.1f}s total.")
+    return saved
+
+def load_registry_listing(input_path=SYNC_INPUT_FILE_PATH):
+    """ID (column B) -> signature of its listing row. Registration date, status, deletion date and the
+    address/staff counts all live in that row, so a different signature means the facility changed."""
+    print(f"Yo shefe, sync targeting: {input_path}")
+    if not os.path.exists(input_path):
+        print("Faila go nyama. Slagay go pri skripta, lyolyo.")
+        sys.exit(1)
+    listing = {}
+    wb = load_workbook(input_path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        if len(header) < 2:
+            print("!!! GRESHKA: Tozi fail nyama Kolona B. Negative IQ moment.")
+            sys.exit(1)
+        keep = [i for i, name in enumerate(header) if i != 1 and name not in SYNC_IGNORED_COLUMNS]
+        for row in rows:
+            id_val = _normalize_id(row[1] if len(row) > 1 else None)
+            if id_val is None:
+                continue
+            sig_source = "\x1f".join("" if i >= len(row) or row[i] is None else str(row[i]) for i in keep)
+            listing[id_val] = hashlib.sha1(sig_source.encode('utf-8')).hexdigest()
+    finally:
+        wb.close()
+    print(f"Loaded {len(listing)} listed ID-chovtsi.")
+    return listing
+
+def _content_hash(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def _row_key(row, columns):
+    return json.dumps([row.get(col) for col in columns], ensure_ascii=False)
+
+class SyncState:
+    """Snapshot of every facility as of its last sync (listing signature, content hash, parsed rows),
+    plus the delta rows each sync run produced. State and delta change in the same transaction.
+    A removed facility stays as a tombstone (removed = 1), so the freshness policy still applies to it."""
+
+    def __init__(self, path=SYNC_STATE_FILE):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS facilities (
+            id TEXT PRIMARY KEY, list_sig TEXT, content_hash TEXT, status TEXT, reg_date TEXT,
+            fetched_at REAL, rows TEXT, removed INTEGER NOT NULL DEFAULT 0)""")
+        if 'removed' not in [row[1] for row in self.db.execute("PRAGMA table_info(facilities)")]: # Pre-tombstone state
+            self.db.execute("ALTER TABLE facilities ADD COLUMN removed INTEGER NOT NULL DEFAULT 0")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS delta (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, run TEXT, sheet TEXT, facility_change TEXT, change TEXT, row TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS idx_delta_run ON delta (run, sheet)")
+        self.db.commit()
+        self.delta_rows = 0 # Emitted by this process - sizes the delta workbook for the time budget
+
+    def plan(self, listing, max_age_days=SYNC_MAX_AGE_DAYS, now=None, shard=None):
+        """Freshness policy -> (IDs to fetch, IDs gone from the listing). New and re-signed IDs come first.
+        With a shard, state rows it no longer owns (SHARD_COUNT changed) are ignored - not "removed"."""
+        now = time.time() if now is None else now
+        known = {id_val: (sig, fetched_at, removed) for id_val, sig, fetched_at, removed
+                 in self.db.execute("SELECT id, list_sig, fetched_at, removed FROM facilities")
+                 if shard is None or shard.owns(id_val)}
+        fresh, stale_by_age = [], []
+        for id_val, sig in listing.items():
+            if id_val not in known or known[id_val][0] != sig:
+                fresh.append(id_val)
+            elif max_age_days and now - (known[id_val][1] or 0) > max_age_days * 86400:
+                stale_by_age.append(id_val)
+        stale_by_age.sort(key=lambda x: known[x][1] or 0) # Oldest first
+        removed = [id_val for id_val, (_, _, is_removed) in known.items() if id_val not in listing and not is_removed]
+        return fresh + stale_by_age, removed
+
+    def _emit(self, run, facility_change, change, rows_by_sheet):
+        self.delta_rows += sum(len(rows) for rows in rows_by_sheet.values())
+        self.db.executemany(
+            "INSERT INTO delta (run, sheet, facility_change, change, row) VALUES (?, ?, ?, ?, ?)",
+            [(run, sheet, facility_change, change, json.dumps(row, ensure_ascii=False))
+             for sheet, rows in rows_by_sheet.items() for row in rows])
+
+    def apply(self, run, id_val, list_sig, data, rows_by_sheet):
+        """Stores a fresh fetch. Returns 'new', 'changed' or None (same content, only timestamps move)."""
+        new_hash = _content_hash(data)
+        old = self.db.execute("SELECT content_hash, rows FROM facilities WHERE id = ? AND removed = 0", (id_val,)).fetchone()
+        record = data[0] if isinstance(data, list) and data else data
+        record = record if isinstance(record, dict) else {}
+        self.db.execute("INSERT OR REPLACE INTO facilities VALUES (?, ?, ?, ?, ?, ?, ?, 0)", (
+            id_val, list_sig, new_hash, record.get('statuslabel'), record.get('registrationDate'),
+            time.time(), json.dumps(rows_by_sheet, ensure_ascii=False)))
+        if old is None: # Never seen, or back from a tombstone
+            self._emit(run, 'new', 'added', rows_by_sheet)
+            return 'new'
+        if old[0] == new_hash:
+            return None
+        old_rows = json.loads(old[1] or '{}')
+        for sheet, columns in SHEETS:
+            # Address_ID is derived from the other columns - snapshots from before it existed still match
+            columns = [col for col in columns if col != 'Address_ID']
+            before = {_row_key(r, columns): r for r in old_rows.get(sheet, [])}
+            after = {_row_key(r, columns): r for r in rows_by_sheet.get(sheet, [])}
+            self._emit(run, 'changed', 'removed', {sheet: [r for k, r in before.items() if k not in after]})
+            self._emit(run, 'changed', 'added', {sheet: [r for k, r in after.items() if k not in before]})
+        return 'changed'
+
+    def remove(self, run, id_val, list_sig=None):
+        """Tombstones a facility. `list_sig` = still listed (the API said 404): it is re-checked like any other
+        listed ID - by age, or as soon as its listing row changes. None = gone from the listing: it comes back
+        as new if it's ever listed again. True if this removed a live facility (delta rows emitted)."""
+        old = self.db.execute("SELECT rows, removed FROM facilities WHERE id = ?", (id_val,)).fetchone()
+        if old and not old[1]:
+            self._emit(run, 'removed', 'removed', json.loads(old[0] or '{}'))
+        self.db.execute("INSERT OR REPLACE INTO facilities (id, list_sig, fetched_at, removed) VALUES (?, ?, ?, 1)",
+                        (id_val, list_sig, time.time()))
+        return bool(old and not old[1])
+
+    def commit(self):
+        self.db.commit()
+
+    def iter_delta(self, run, sheet):
+        for facility_change, change, row in self.db.execute(
+                "SELECT facility_change, change, row FROM delta WHERE run = ? AND sheet = ? ORDER BY seq", (run, sheet)):
+            yield dict(json.loads(row), Facility_Change=facility_change, Change=change)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def sync_loop(input_path=SYNC_INPUT_FILE_PATH, max_age_days=SYNC_MAX_AGE_DAYS, shard=None):
+    """Incremental re-sync: fetch only what the freshness policy flags, write a delta workbook of what moved."""
+    shard = shard or Shard(0, 1)
+    listing = load_registry_listing(input_path)
+    if shard.count > 1:
+        # Each shard's listing is only its own slice - plan() skips state rows of other slices to match
+        listing = {k: v for k, v in listing.items() if shard.owns(k)}
+        print(f"Running as {shard}: {len(listing)} listed ID-chovtsi are ours.")
+    state = SyncState(shard.path(SYNC_STATE_FILE))
+    to_fetch, removed = state.plan(listing, max_age_days, shard=shard)
+    print(f"Sync plan: {len(to_fetch)} to (re)fetch, {len(removed)} gone from the listing "
+          f"(max age {max_age_days:g} days).")
+
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+    time_limit_hit = False
+    budget = TimeBudget(SAVE_SECONDS_PER_DELTA_ROW)
+    budget.install_signal_handlers()
+
+    def out_of_time():
+        nonlocal time_limit_hit
+        # The delta workbook has to fit in the budget as well
+        if budget.should_stop(state.delta_rows):
+            time_limit_hit = True
+        return time_limit_hit
+
+    try:
+        ADDRESS_CACHE.open_disk(shard.path(ADDRESS_CACHE_FILE))
+    except sqlite3.Error as e:
+        print(f"Address cache on disk is cooked ({e}), running memory-only.")
+    raw_store = _open_raw_store(shard.path(RAW_STORE_FILE))
+    registry = _open_registry(shard.path(REGISTRY_DB_FILE))
+
+    def commit():
+        # Responses + registry first: once the state says "synced", the next plan won't fetch the ID again
+        for store in (raw_store, registry):
+            if store:
+                store.commit()
+        state.commit()
+
+    for id_val in removed:
+        counts['removed'] += state.remove(TIMESTAMP, id_val)
+        if registry:
+            registry.mark_removed(id_val)
+    commit()
+    session = make_session(CONCURRENCY)
+    limiter = AdaptiveRateLimiter()
+
+    for i, (id_number, data, failure) in enumerate(fetch_many(to_fetch, session, limiter, CONCURRENCY, out_of_time, budget.interrupted)):
+        if data:
+            if raw_store:
+                raw_store.put(id_number, data)
+            hospitals, addresses, doctors = [], [], []
+            try:
+                with METRICS.timer('parse'):
+                    parse_data(data, hospitals, addresses, doctors)
+            except Exception as e:
+                counts['failed'] += 1
+                METRICS.id_finished('failed')
+                print(f"    [-] Parser tripped on {id_number}: {e}")
+                continue
+            outcome = state.apply(TIMESTAMP, id_number, listing[id_number], data,
+                                  {'Hospitals': hospitals, 'Addresses': addresses, 'Doctors': doctors})
+            if registry:
+                registry.upsert(data)
+            counts[outcome or 'unchanged'] += 1
+            METRICS.id_finished('done')
+        elif failure[0] == NOT_FOUND:
+            # Listed but the API says it's gone - treat as removed
+            counts['removed'] += state.remove(TIMESTAMP, id_number, listing[id_number])
+            if registry:
+                registry.mark_removed(id_number)
+            METRICS.id_finished('done')
+        else:
+            # Blip or weirdness - state untouched, it stays stale and gets picked up by the next sync
+            counts['failed'] += 1
+            METRICS.id_finished('failed')
+        if (i + 1) % CHECKPOINT_EVERY_IDS == 0:
+            commit()
+        METRICS.progress(i + 1, len(to_fetch), limiter, label="sync ")
+
+    session.close()
+    commit()
+    if raw_store:
+        raw_store.close()
+    if registry:
+        registry.close()
+    ADDRESS_CACHE.close()
+    print(f"Sync done: {counts}")
+
+    if time_limit_hit:
+        print(f"\n!!! TIME LIMIT REACHED ({budget.stop_reason}) !!! The rest stays stale for the next sync run.")
+        with open(CONTINUE_FLAG_FILE, 'w') as f:
+            f.write("MORE_BLOOD")
+
+    if counts['new'] or counts['changed'] or counts['removed']:
+        delta_sheets = [(sheet, DELTA_COLUMNS + columns) for sheet, columns in SHEETS]
+        save_multisheet_excel(*(state.iter_delta(TIMESTAMP, sheet) for sheet, _ in SHEETS),
+                              output_file=shard.path(DELTA_FILE), sheets=delta_sheets)
+    else:
+        print("Nothing moved in the registry. Ez clap.")
+    state.close()
+    METRICS.report(shard.path(PERF_REPORT_FILE), mode='sync', shard=str(shard), ids_pending=len(to_fetch),
+                   time_limit_hit=time_limit_hit, stop_reason=budget.stop_reason, sync_counts=counts, final_rate=round(limiter.rate, 2),
+                   throttle_events=limiter.throttle_count, address_cache=_address_cache_counts())
+
+def _iter_sheet_dicts(books, sheet):
+    for book in books:
+        if sheet not in book.sheetnames:
+            continue
+        rows = book[sheet].iter_rows(values_only=True)
+        header = next(rows, None)
+        for row in rows:
+            yield dict(zip(header, row))
+
+def merge_workbooks(paths, output_file):
+    """Concatenates same-named sheets of several workbooks (read_only in, write_only out - streamed).
+    Unique_Addresses is rebuilt from the merged Addresses instead - shards share locations."""
+    books = [load_workbook(p, read_only=True) for p in paths]
+    try:
+        wb = Workbook(write_only=True)
+        sheet_names = list(dict.fromkeys(name for book in books for name in book.sheetnames))
+        for name in sheet_names:
+            ws = wb.create_sheet(name)
+            if name == UNIQUE_ADDRESS_SHEET:
+                ws.append(UNIQUE_ADDRESS_COLUMNS)
+                for row in AddressIndex.unique_rows(_iter_sheet_dicts(books, 'Addresses')):
+                    ws.append([row[col] for col in UNIQUE_ADDRESS_COLUMNS])
+                continue
+            header_written = False
+            for book in books:
+                if name not in book.sheetnames:
+                    continue
+                rows = book[name].iter_rows(values_only=True)
+                header = next(rows, None)
+                if header is not None and not header_written:
+                    ws.append(header)
+                    header_written = True
+                for row in rows:
+                    ws.append(row)
+        wb.save(output_file)
+    finally:
+        for book in books:
+            book.close()
+    print(f"SAVED BATCH: {output_file} (merged {len(paths)} workbooks)")
+
+def merge_shards(output_file=OUTPUT_FILE, delta_file=DELTA_FILE):
+    """Folds per-shard progress logs into the shared ones and per-shard workbooks into one."""
+    checkpoint = Checkpoint()
+    done, failed, retry_entries = [], {}, {}
+    for path in shard_files(PROCESSED_LOG_FILE):
+        done.extend(sorted(get_processed_ids(path)))
+    for path in shard_files(FAILED_LOG_FILE):
+        failed.update(get_failed_ids(path))
+    for path in shard_files(RETRY_QUEUE_FILE):
+        retry_entries.update(RetryQueue(path).entries)
+    before = len(checkpoint.done), len(checkpoint.failed)
+    checkpoint.commit(done, failed)
+    # A shard's queue is the truth for its IDs; whatever got settled meanwhile drops out
+    checkpoint.retry.entries.update(retry_entries)
+    for id_val in list(checkpoint.retry.entries):
+        if checkpoint.is_settled(id_val):
+            checkpoint.retry.discard(id_val)
+    checkpoint.retry.save()
+    print(f"Merged progress: +{len(checkpoint.done) - before[0]} done, +{len(checkpoint.failed) - before[1]} failed, "
+          f"{len(checkpoint.retry)} waiting for a retry.")
+    for path in shard_files(PROCESSED_LOG_FILE) + shard_files(FAILED_LOG_FILE) + shard_files(RETRY_QUEUE_FILE):
+        os.remove(path)
+
+    # Raw responses too, so `reparse` sees every shard's answers (newest fetch wins)
+    shard_stores = shard_files(RAW_STORE_FILE)
+    if shard_stores:
+        store = RawStore()
+        for path in shard_stores:
+            store.db.execute("ATTACH DATABASE ? AS shard", (path,))
+            store.db.execute("""INSERT OR REPLACE INTO responses SELECT s.id, s.fetched_at, s.body FROM shard.responses s
+                                LEFT JOIN responses r ON r.id = s.id WHERE r.id IS NULL OR s.fetched_at >= r.fetched_at""")
+            store.db.commit()
+            store.db.execute("DETACH DATABASE shard")
+        print(f"Merged {len(shard_stores)} shard raw stores -> {store.count()} responses.")
+        store.close()
+        for path in shard_stores:
+            for leftover in (path, path + "-wal", path + "-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    # Registry: the shard DBs say which facilities they touched, the (merged) raw store has their latest response
+    shard_registries = shard_files(REGISTRY_DB_FILE)
+    if shard_registries:
+        registry, store = RegistryStore(), RawStore()
+        upserted = removed = missing = 0
+        for path in shard_registries:
+            shard_db = sqlite3.connect(path)
+            for id_val, removed_at in shard_db.execute("SELECT id, removed_at FROM hospitals"):
+                if removed_at is not None:
+                    registry.mark_removed(id_val, removed_at)
+                    removed += 1
+                    continue
+                data = store.get(id_val)
+                if data is None:
+                    missing += 1
+                    continue
+                registry.upsert(data)
+                upserted += 1
+            shard_db.close()
+        store.close()
+        print(f"Merged {len(shard_registries)} shard registries: {upserted} upserted, {removed} removed"
+              + (f", {missing} without a stored response (run `export --rebuild` once a raw store has them)" if missing else "")
+              + f" -> {registry.counts()}")
+        registry.close()
+        for path in shard_registries:
+            for leftover in (path, path + "-wal", path + "-shm"):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+
+    for pattern, target in (("FINAL_DOCTORS_BATCH_*.shard-*.xlsx", output_file), ("DELTA_SYNC_*.shard-*.xlsx", delta_file)):
+        paths = sorted(glob.glob(os.path.join(SCRIPT_DIR, pattern)))
+        if paths:
+            merge_workbooks(paths, target)
+            for path in paths:
+                os.remove(path)
+
+    # Empty part roots go; non-empty ones hold a crashed shard's rows -> `consolidate --shard-index N`
+    for path in glob.glob(os.path.join(SCRIPT_DIR, os.path.basename(PARTS_ROOT) + ".shard-*")):
+        if os.path.isdir(path) and not os.listdir(path):
+            os.rmdir(path)
+        elif os.path.isdir(path):
+            print(f"{os.path.basename(path)} still has unconsolidated parts, run `consolidate` for that shard.")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Outpatient care registry scraper (registries.his.bg).")
+    parser.add_argument('mode', nargs='?', default='scrape', choices=['scrape', 'sync', 'reparse', 'consolidate', 'merge', 'export'],
+                        help="scrape: fetch pending IDs (default). sync: re-fetch only new/changed/stale facilities "
+                             "and write a delta workbook. reparse: rebuild the outputs from stored raw responses "
+                             "(no network). consolidate: merge leftover part files into a workbook. "
+                             "merge: fold per-shard progress logs and workbooks together. "
+                             "export: write the whole registry DB as one workbook.")
+    parser.add_argument('--input', help="Registry workbook (default: Remaining for scrape, FULL for sync)")
+    parser.add_argument('--max-age-days', type=float, default=SYNC_MAX_AGE_DAYS,
+                        help="sync: re-fetch unchanged listings older than this (0 = only new/changed)")
+    parser.add_argument('--workers', type=int, help="reparse: worker processes (default: all cores)")
+    parser.add_argument('--rebuild', action='store_true', help="export: replace every facility in the registry from the stored raw responses first")
+    parser.add_argument('--output', help="export: workbook path (default: REGISTRY_EXPORT_<timestamp>.xlsx)")
+    parser.add_argument('--shard-index', type=int, default=SHARD_INDEX, help="scrape/sync: this runner's shard (0-based)")
+    parser.add_argument('--shard-count', type=int, default=SHARD_COUNT, help="scrape/sync: total number of shards")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main_loop()
+    args = parse_args()
+    shard = Shard(args.shard_index, args.shard_count)
+    if args.mode == 'consolidate':
+        parts_root = shard.path(PARTS_ROOT)
+        Checkpoint(shard.path(PROCESSED_LOG_FILE), shard.path(FAILED_LOG_FILE), shard.path(RETRY_QUEUE_FILE),
+                   shard).recover(find_part_dirs(parts_root))
+        if not consolidate_parts(find_part_dirs(parts_root), shard.path(OUTPUT_FILE)):
+            print("No part files to consolidate. L.")
+    elif args.mode == 'reparse':
+        reparse_loop(args.workers)
+    elif args.mode == 'merge':
+        merge_shards()
+    elif args.mode == 'export':
+        export_registry(args.output or REGISTRY_EXPORT_FILE, args.rebuild)
+    elif args.mode == 'sync':
+        sync_loop(args.input or SYNC_INPUT_FILE_PATH, args.max_age_days, shard)
+    else:
+        main_loop(args.input or INPUT_FILE_PATH, shard)